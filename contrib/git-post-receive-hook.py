@@ -3,33 +3,59 @@
 
 """
     Post-receive hook for git.
+
+    The hook doesn't talk to trompet itself: it writes the messages to
+    a spool directory and starts a detached flusher (this script, run
+    with ``--flush``) that delivers them. That way, pushing never
+    waits for trompet, even if it is slow or unreachable.
 """
 
 from __future__ import with_statement
+import errno
+import fcntl
+try:
+    import json
+except ImportError:
+    import simplejson as json
 import os
+import socket
 import string
 import subprocess
 import sys
+import tempfile
+import time
+from itertools import islice
 from xmlrpclib import ServerProxy
 
 
 ### CONFIG SETTINGS START HERE
 
 XMLRPC_ADDR =  ('localhost', 1234)
+# Path of trompet's UNIX socket. If set, it is used instead of XML-RPC
+# (for git servers on the same machine as trompet).
+UNIX_SOCKET = None
 PROJECT_TOKEN = 'example token'
 MESSAGE = string.Template(
     "$author committed rev $rev to $repo/$branch: $shortmessage")
+# Maximum number of commit messages per ref update (None means unlimited)
+MAX_COMMITS_PER_PUSH = None
+# Directory for messages that have not been delivered yet. Must not be
+# shared by hooks using different project tokens.
+SPOOL_DIR = os.path.expanduser('~/.trompet-spool/' + PROJECT_TOKEN)
+# Timeout for a single delivery attempt in seconds
+DELIVERY_TIMEOUT = 10
+# Seconds to wait between delivery attempts: doubled after every failed
+# attempt, up to MAX_RETRY_DELAY. The flusher gives up (and leaves the
+# messages to the next push's flusher) after MAX_ATTEMPTS attempts.
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+MAX_ATTEMPTS = 10
+# Maximum number of spooled pushes that are delivered with one call
+MAX_BATCHES_PER_CALL = 50
 
 ### END OF CONFIG SETTINGS
 
 
-def get_output(*args):
-    """Returns a subprocess's output as unicode string. Assumes the
-    output is encoded in UTF-8.
-    """
-    data = subprocess.Popen(args, stdout=subprocess.PIPE).communicate()[0]
-    return data.strip().decode("utf-8")
-
 def short_commit_message(message):
     "Returns the first line of a commit message."
     lines = message.splitlines()
@@ -38,32 +64,195 @@ def short_commit_message(message):
         shortmessage += u"…"
     return shortmessage
 
-def format_commit_message(repo, refname, rev):
-    message = get_output('git', 'cat-file', 'commit', rev)
-
-    attributes = dict(branch=refname, repo=repo, rev=rev[:12])
-    linesiter = iter(message.splitlines())
-    for line in linesiter:
-        if not line:
-            break
-        (key, value) = line.split(None, 1)
-        if key in ['author', 'committer']:
-            # Remove date
-            value = value.rsplit(None, 2)[0]
-            # Remove mail address
-            try:
-                value = value[:value.index(' <')]
-            except ValueError:
-                pass
-        attributes[key] = value
-    message = '\n'.join(linesiter)
-    attributes['message'] = message
-    attributes['shortmessage'] = short_commit_message(message)
+# Fields are separated by ASCII unit separators, commits by NUL bytes
+# (see `git log -z`). The message comes last, so it may contain anything.
+LOG_FORMAT = '%x1f'.join(['%H', '%T', '%P', '%an', '%cn', '%B'])
+LOG_FIELDS = ['rev', 'tree', 'parent', 'author', 'committer', 'message']
+
+def iter_commits(*revisions):
+    """Yields a dict of attributes for every commit selected by
+    `revisions` (oldest first). All commits are read from the output
+    of a single `git log` process, which is killed if the generator
+    isn't exhausted.
+    """
+    process = subprocess.Popen(
+        ['git', 'log', '--reverse', '-z', '--format=' + LOG_FORMAT] +
+        list(revisions) + ['--'],
+        stdout=subprocess.PIPE)
+    try:
+        pending = ''
+        while True:
+            data = process.stdout.read(65536)
+            if not data:
+                break
+            records = (pending + data).split('\0')
+            pending = records.pop()
+            for record in records:
+                yield parse_commit(record)
+        if pending:
+            yield parse_commit(pending)
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.terminate()
+        process.wait()
+
+def parse_commit(record):
+    values = record.decode('utf-8', 'replace').split(u'\x1f', 5)
+    attributes = dict(zip(LOG_FIELDS, values))
+    parents = attributes['parent'].split()
+    attributes['parent'] = parents[-1] if parents else u''
+    attributes['message'] = attributes['message'].strip()
+    return attributes
+
+def format_commit_message(repo, refname, commit):
+    attributes = dict(commit, branch=refname, repo=repo,
+                      rev=commit['rev'][:12])
+    attributes['shortmessage'] = short_commit_message(commit['message'])
     return MESSAGE.safe_substitute(**attributes)
 
+def count_commits(*revisions):
+    "Returns the number of commits selected by `revisions`."
+    process = subprocess.Popen(
+        ['git', 'rev-list', '--count'] + list(revisions) + ['--'],
+        stdout=subprocess.PIPE)
+    return int(process.communicate()[0])
+
+def format_commit_messages(repo, refname, *revisions):
+    """Returns the messages for the commits selected by `revisions`,
+    at most `MAX_COMMITS_PER_PUSH` plus a line with the number of
+    omitted commits. Omitted commits are counted by git, they are
+    never read.
+    """
+    commits = iter_commits(*revisions)
+    messages = [format_commit_message(repo, refname, commit)
+                for commit in islice(commits, MAX_COMMITS_PER_PUSH)]
+    # Stops `git log` if there are more commits
+    commits.close()
+    if len(messages) == MAX_COMMITS_PER_PUSH:
+        omitted_commits = count_commits(*revisions) - len(messages)
+        if omitted_commits:
+            messages.append('[%i commits omitted.]' % (omitted_commits, ))
+    return messages
+
+def spool(messages):
+    """Atomically writes the given messages as one batch into the
+    spool directory.
+    """
+    if not os.path.isdir(SPOOL_DIR):
+        os.makedirs(SPOOL_DIR)
+    (fd, path) = tempfile.mkstemp(dir=SPOOL_DIR, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as batch_file:
+        batch_file.write(u'\n'.join(messages).encode('utf-8'))
+    # Batches are named after the time they were spooled, so that they
+    # are delivered in order
+    name = '%.6f-%i.batch' % (time.time(), os.getpid())
+    os.rename(path, os.path.join(SPOOL_DIR, name))
+
+def spooled_batches():
+    "Returns the paths of all spooled batches, oldest first."
+    try:
+        names = os.listdir(SPOOL_DIR)
+    except OSError:
+        return []
+    return [os.path.join(SPOOL_DIR, name)
+            for name in sorted(names) if name.endswith('.batch')]
+
+def start_flusher():
+    "Starts a detached flusher process and returns immediately."
+    devnull = open(os.devnull, 'r+')
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), '--flush'],
+                     stdin=devnull, stdout=devnull, stderr=devnull,
+                     close_fds=True, preexec_fn=os.setsid)
+
+def deliver(batches):
+    """Sends the messages of the given batches to trompet with a single
+    call. Raises an exception if delivery failed.
+    """
+    messages = []
+    for path in batches:
+        with open(path) as batch_file:
+            messages.append(batch_file.read().decode('utf-8'))
+    message = u'\n'.join(messages)
+    if UNIX_SOCKET:
+        notify_unix(message)
+    else:
+        addr_params = XMLRPC_ADDR + (PROJECT_TOKEN, )
+        bot = ServerProxy('http://%s:%i/%s/xmlrpc' % addr_params)
+        bot.notify(message)
+
+_unix_connection = None
+
+def notify_unix(message):
+    """Sends a message through trompet's UNIX socket. The connection is
+    kept open for further deliveries of the flusher.
+    """
+    global _unix_connection
+    if _unix_connection is None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(UNIX_SOCKET)
+        _unix_connection = sock.makefile('r+')
+    try:
+        request = json.dumps({'token': PROJECT_TOKEN, 'message': message})
+        _unix_connection.write(request + '\n')
+        _unix_connection.flush()
+        reply = json.loads(_unix_connection.readline())
+    except Exception:
+        _unix_connection = None
+        raise
+    if not reply.get('ok'):
+        raise ValueError('trompet refused message: %s' % (reply['error'], ))
+
+def flush_spool():
+    """Delivers spooled batches until the spool is empty. Only one
+    flusher runs at a time; additional flushers exit right away, the
+    running one picks up their batches.
+    """
+    socket.setdefaulttimeout(DELIVERY_TIMEOUT)
+    if not os.path.isdir(SPOOL_DIR):
+        return
+    while spooled_batches():
+        with open(os.path.join(SPOOL_DIR, '.lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return
+                raise
+            if not flush_locked_spool():
+                return
+        # Check again after releasing the lock: a push may have spooled
+        # a batch while its flusher couldn't get the lock.
+
+def flush_locked_spool():
+    """Delivers batches while holding the spool lock. Returns `False` if
+    the flusher gave up.
+    """
+    attempts = 0
+    delay = RETRY_DELAY
+    while True:
+        batches = spooled_batches()[:MAX_BATCHES_PER_CALL]
+        if not batches:
+            return True
+        try:
+            deliver(batches)
+        except Exception:
+            attempts += 1
+            if attempts >= MAX_ATTEMPTS:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+        else:
+            attempts = 0
+            delay = RETRY_DELAY
+            for path in batches:
+                os.remove(path)
+
 def main():
-    addr_params = XMLRPC_ADDR + (PROJECT_TOKEN, )
-    bot = ServerProxy('http://%s:%i/%s/xmlrpc' % addr_params)
+    if sys.argv[1:] == ['--flush']:
+        flush_spool()
+        return
+
     repo = os.path.basename(os.getcwd())
     if repo.endswith('.git'):
         repo = repo[:-len('.git')]
@@ -75,20 +264,18 @@ def main():
             refname = refname[len('refs/heads/'):]
             if new.strip('0'):
                 if old.strip('0'):
-                    revisions = get_output('git', 'rev-list',
-                                            '%s..%s' % (old, new)).splitlines()
-                    for revision in reversed(revisions):
-                        msg = format_commit_message(repo, refname, revision)
-                        messages.append(msg)
+                    messages.extend(format_commit_messages(
+                        repo, refname, '%s..%s' % (old, new)))
                 else:
                     messages.append('New branch: %s/%s' % (repo, refname))
-                    messages.append(
-                        format_commit_message(repo, refname, new))
+                    messages.extend(
+                        format_commit_messages(repo, refname, '-1', new))
             else:
                 messages.append(
                     'Branch %s/%s deleted (was: %s)' % (repo, refname, old))
     if messages:
-        bot.notify("\n".join(messages))
+        spool(messages)
+        start_flusher()
 
 if __name__ == '__main__':
     main()
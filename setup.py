@@ -19,7 +19,8 @@ def regenerate_dropin_cache():
 setup(
     name="trompet",
     description="The commit announcement IRC bot.",
-    packages=["trompet", "trompet.listeners", "trompet.test", "twisted.plugins"],
+    packages=["trompet", "trompet.benchmarks", "trompet.listeners",
+              "trompet.test", "twisted.plugins"],
     version="0.1",
     author="Andreas Stührk",
     author_email="andreas@buffer.io",
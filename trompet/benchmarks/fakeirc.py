@@ -0,0 +1,100 @@
+# encoding: utf-8
+
+"""
+    A minimal IRC server for benchmarks. It speaks just enough IRC for
+    trompet (registration, JOIN, PING, PRIVMSG), records when each
+    message arrives and enforces a flood policy like most IRC servers
+    do: every line costs `penalty` seconds, lines that put the client
+    more than `burst` seconds ahead are delayed, and a client with more
+    than `max_queued` delayed lines is disconnected ("Excess Flood").
+"""
+
+from twisted.internet import protocol, reactor
+from twisted.protocols import basic
+
+
+class Message(object):
+    __slots__ = ["arrival", "network", "target", "text"]
+
+    def __init__(self, arrival, network, target, text):
+        self.arrival = arrival
+        self.network = network
+        self.target = target
+        self.text = text
+
+
+class FakeIRCProtocol(basic.LineOnlyReceiver):
+    delimiter = "\n"
+    MAX_LENGTH = 4096
+
+    hostname = "fake.irc"
+    userhost = "trompet@bench.example.org"
+
+    def connectionMade(self):
+        self.nickname = None
+        # Time up to which the client used its flood budget
+        self.message_time = 0
+        self.queued = 0
+
+    def lineReceived(self, line):
+        line = line.rstrip("\r")
+        if len(line) + 2 > 512:
+            self.factory.overlong_lines += 1
+        now = self.factory.clock.seconds()
+        self.message_time = max(self.message_time, now) + self.factory.penalty
+        delay = self.message_time - now - self.factory.burst
+        if delay <= 0:
+            self.process(line, now)
+            return
+        self.queued += 1
+        if self.queued > self.factory.max_queued:
+            self.factory.flood_kills += 1
+            self.sendLine("ERROR :Closing Link: (Excess Flood)")
+            self.transport.loseConnection()
+            return
+        self.factory.clock.callLater(delay, self._process_delayed, line)
+
+    def _process_delayed(self, line):
+        self.queued -= 1
+        self.process(line, self.factory.clock.seconds())
+
+    def process(self, line, now):
+        (command, _, params) = line.partition(" ")
+        command = command.upper()
+        if command == "NICK":
+            self.nickname = params.lstrip(":")
+            self.send("001", self.nickname, ":Welcome to the fake network")
+        elif command == "PING":
+            self.send("PONG", self.hostname, params)
+        elif command == "JOIN":
+            for channel in params.split(","):
+                self.factory.joined.add(channel)
+                self.sendLine(":%s!%s JOIN %s" % (
+                    self.nickname, self.userhost, channel))
+        elif command == "PRIVMSG":
+            (target, _, text) = params.partition(" :")
+            self.factory.messages.append(
+                Message(now, self.factory.network, target, text))
+            self.factory.message_received(self.factory.messages[-1])
+
+    def send(self, command, *params):
+        self.sendLine(":%s %s %s" % (self.hostname, command, " ".join(params)))
+
+
+class FakeIRCFactory(protocol.ServerFactory):
+    protocol = FakeIRCProtocol
+
+    def __init__(self, network, penalty=2.0, burst=10.0, max_queued=200,
+                 clock=reactor):
+        self.network = network
+        self.penalty = penalty
+        self.burst = burst
+        self.max_queued = max_queued
+        self.clock = clock
+        self.joined = set()
+        self.messages = []
+        self.flood_kills = 0
+        self.overlong_lines = 0
+
+    def message_received(self, message):
+        "Called for every PRIVMSG after the flood policy was applied."
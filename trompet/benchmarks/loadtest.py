@@ -0,0 +1,370 @@
+# encoding: utf-8
+
+"""
+    End-to-end load benchmark.
+
+    Starts the real trompet service from a generated configuration
+    against in-process fake IRC servers (see `trompet.benchmarks.fakeirc`),
+    posts synthetic GitHub, Bitbucket and Travis CI webhooks at a fixed
+    rate and reports throughput, HTTP-to-IRC latency and peak RSS as
+    JSON. Run it with::
+
+        python -m trompet.benchmarks.loadtest --projects 10 --rate 20
+
+    The fake servers, the webhook generator and trompet share one
+    process and one reactor, so the peak RSS includes the harness.
+"""
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import urllib
+from hashlib import sha256
+from StringIO import StringIO
+
+from twisted.application import internet
+from twisted.internet import defer, reactor, task
+from twisted.python import usage
+from twisted.web.client import (Agent, FileBodyProducer, HTTPConnectionPool,
+                                readBody)
+from twisted.web.http_headers import Headers
+
+from trompet.benchmarks.fakeirc import FakeIRCFactory
+from trompet.service import TrompetMaker
+
+
+MESSAGE_FORMAT = "$revision $shortmessage"
+TRAVIS_SLUG = "bench/project"
+TRAVIS_TOKEN = "travis-token"
+
+
+class LoadTestOptions(usage.Options):
+    optParameters = [
+        ["projects", None, 10, "Number of projects.", int],
+        ["channels", None, 4, "Number of channels per network.", int],
+        ["networks", None, 1, "Number of IRC networks.", int],
+        ["webhooks", None, 50, "Number of webhooks to post.", int],
+        ["rate", None, 10.0, "Webhooks per second (0: as fast as possible).",
+         float],
+        ["commits", None, 1, "Commits per GitHub/Bitbucket webhook.", int],
+        ["forges", None, "github,bitbucket,travisci",
+         "Comma-separated list of webhook types to post."],
+        ["flood-penalty", None, 2.0, "Seconds of flood budget per line.",
+         float],
+        ["flood-burst", None, 10.0, "Flood budget in seconds.", float],
+        ["flood-queue", None, 200,
+         "Delayed lines before the server disconnects the bot.", int],
+        ["timeout", None, 300.0, "Seconds to wait for all messages.", float],
+        ["join-timeout", None, 30.0,
+         "Seconds to wait until the bots joined all channels.", float],
+        ["output", "o", None, "Write the report to this file."],
+    ]
+
+
+def generate_config(directory, options, irc_ports):
+    """Writes a trompet configuration with the given number of projects
+    to `directory`. Returns the path of the configuration file.
+    """
+    networks = {}
+    for (i, port) in enumerate(irc_ports):
+        networks["net%i" % (i, )] = {"servers": [["127.0.0.1", port]],
+                                     "nick": "trompet%i" % (i, )}
+    projects = {}
+    for i in range(options["projects"]):
+        network = "net%i" % (i % options["networks"], )
+        channel = "#bench-%i" % (i % options["channels"], )
+        projects["project%i" % (i, )] = {
+            "channels": {network: [channel]},
+            "token": "token%i" % (i, ),
+            "github": {"message": MESSAGE_FORMAT},
+            "bitbucket": {"message": MESSAGE_FORMAT},
+            "travisci": {"message": MESSAGE_FORMAT, "token": TRAVIS_TOKEN},
+        }
+    config = {"networks": networks,
+              "web": {"port": 0, "password": "bench"},
+              "projects": projects}
+    path = os.path.join(directory, "config.json")
+    with open(path, "w") as config_file:
+        json.dump(config, config_file)
+    return path
+
+def github_payload(ids):
+    commits = [{"id": commit_id, "message": "Synthetic commit",
+                "url": "http://example.org/" + commit_id,
+                "author": {"name": "Bench"}}
+               for commit_id in ids]
+    return {"ref": "refs/heads/master", "commits": commits}
+
+def bitbucket_payload(ids):
+    commits = [{"node": commit_id, "message": "Synthetic commit",
+                "author": "Bench", "branch": "default"}
+               for commit_id in ids]
+    return {"repository": {"absolute_url": "/bench/project/"},
+            "commits": commits}
+
+def travisci_payload(ids):
+    return {"author_name": "Bench", "commit": ids[0],
+            "message": "Synthetic commit", "branch": "master",
+            "compare_url": "http://example.org/compare",
+            "status_message": "Passed",
+            "build_url": "http://example.org/build"}
+
+PAYLOADS = {"github": github_payload,
+            "bitbucket": bitbucket_payload,
+            "travisci": travisci_payload}
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def trompet_version():
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution("trompet").version
+    except Exception:
+        return None
+
+def peak_rss_kib():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, OS X bytes
+    if sys.platform == "darwin":
+        maxrss //= 1024
+    return maxrss
+
+
+def expected_joins(config_path):
+    """Returns the channels that the bot of every network has to join
+    according to the configuration at `config_path`.
+    """
+    with open(config_path) as config_file:
+        config = json.load(config_file)
+    joins = dict((network, set()) for network in config["networks"])
+    for project in config["projects"].itervalues():
+        for (network, channels) in project["channels"].iteritems():
+            joins[network].update(channels)
+    return joins
+
+
+class JoinTimeout(Exception):
+    "Raised when the bots didn't join their channels in time."
+
+
+class LoadTest(object):
+    def __init__(self, options):
+        self.options = options
+        self.forges = options["forges"].split(",")
+        self.sent = {}
+        self.latencies = []
+        self.responses = 0
+        self.errors = 0
+        self.finished = defer.Deferred()
+
+    def message_received(self, message):
+        commit_id = message.text.split(" ", 1)[0]
+        sent = self.sent.pop(commit_id, None)
+        if sent is not None:
+            self.latencies.append(message.arrival - sent)
+            if not self.sent and self.posted == self.options["webhooks"]:
+                self._finish()
+
+    def _finish(self):
+        if not self.finished.called:
+            self.finished.callback(None)
+
+    @defer.inlineCallbacks
+    def run(self):
+        self.directory = tempfile.mkdtemp()
+        try:
+            report = yield self._run()
+        finally:
+            shutil.rmtree(self.directory)
+        defer.returnValue(report)
+
+    @defer.inlineCallbacks
+    def _run(self):
+        options = self.options
+        self.irc_factories = []
+        irc_ports = []
+        for i in range(options["networks"]):
+            factory = FakeIRCFactory("net%i" % (i, ), options["flood-penalty"],
+                                     options["flood-burst"],
+                                     options["flood-queue"])
+            factory.message_received = self.message_received
+            self.irc_factories.append(factory)
+            port = reactor.listenTCP(0, factory, interface="127.0.0.1")
+            irc_ports.append(port.getHost().port)
+
+        maker = TrompetMaker()
+        maker.config_path = generate_config(self.directory, options,
+                                            irc_ports)
+        service = self._make_service(maker)
+        service.startService()
+        web_port = [s for s in service
+                    if isinstance(s, internet.TCPServer)][0]._port
+        self.base_url = "http://127.0.0.1:%i/" % (web_port.getHost().port, )
+
+        yield self._wait_for_joins(expected_joins(maker.config_path))
+        pool = HTTPConnectionPool(reactor)
+        self.agent = Agent(reactor, pool=pool)
+        self.posted = 0
+        started = time.time()
+        posts = []
+        interval = 1.0 / options["rate"] if options["rate"] else 0
+        for i in range(options["webhooks"]):
+            posts.append(self._post(i))
+            self.posted += 1
+            if interval:
+                yield task.deferLater(reactor, interval, lambda: None)
+        yield defer.DeferredList(posts)
+        http_elapsed = time.time() - started
+        if self.sent:
+            timeout = reactor.callLater(options["timeout"], self._finish)
+            yield self.finished
+            if timeout.active():
+                timeout.cancel()
+        elapsed = time.time() - started
+
+        yield service.stopService()
+        yield pool.closeCachedConnections()
+        defer.returnValue(self._report(http_elapsed, elapsed))
+
+    def _make_service(self, maker):
+        class Options(object):
+            config = maker.config_path
+        return maker.makeService(Options())
+
+    def _wait_for_joins(self, expected):
+        """Returns a Deferred that fires once every fake server saw the
+        joins in `expected` (a dict mapping networks to channels), or
+        fails with `JoinTimeout` after the join timeout.
+        """
+        factories = dict((factory.network, factory)
+                         for factory in self.irc_factories)
+        d = defer.Deferred()
+
+        def missing():
+            result = {}
+            for (network, channels) in expected.iteritems():
+                not_joined = channels - factories[network].joined
+                if not_joined:
+                    result[network] = sorted(not_joined)
+            return result
+
+        def check():
+            if not missing():
+                call.stop()
+                timeout.cancel()
+                d.callback(None)
+
+        def timed_out():
+            call.stop()
+            d.errback(JoinTimeout("Channels not joined after %g seconds: %r"
+                                  % (self.options["join-timeout"], missing())))
+
+        call = task.LoopingCall(check)
+        timeout = reactor.callLater(self.options["join-timeout"], timed_out)
+        call.start(0.05)
+        return d
+
+    def _post(self, number):
+        forge = self.forges[number % len(self.forges)]
+        project = number % self.options["projects"]
+        commits = 1 if forge == "travisci" else self.options["commits"]
+        ids = ["w%ic%i" % (number, i) for i in range(commits)]
+        body = urllib.urlencode(
+            {"payload": json.dumps(PAYLOADS[forge](ids))})
+        headers = Headers({"Content-Type":
+                           ["application/x-www-form-urlencoded"]})
+        if forge == "travisci":
+            headers.addRawHeader("Travis-Repo-Slug", TRAVIS_SLUG)
+            headers.addRawHeader(
+                "Authorization",
+                sha256(TRAVIS_SLUG + TRAVIS_TOKEN).hexdigest())
+        url = "%stoken%i/%s" % (self.base_url, project, forge)
+        now = reactor.seconds()
+        for commit_id in ids:
+            self.sent[commit_id] = now
+        d = self.agent.request("POST", url, headers,
+                               FileBodyProducer(StringIO(body)))
+        d.addCallback(self._response_received)
+        d.addErrback(self._request_failed, ids)
+        return d
+
+    def _response_received(self, response):
+        if response.code != 200:
+            self.errors += 1
+        else:
+            self.responses += 1
+        return readBody(response)
+
+    def _request_failed(self, failure, ids):
+        self.errors += 1
+        for commit_id in ids:
+            self.sent.pop(commit_id, None)
+
+    def _report(self, http_elapsed, elapsed):
+        lines = sum(len(f.messages) for f in self.irc_factories)
+        return {
+            "trompet_version": trompet_version(),
+            "python": platform.python_version(),
+            "parameters": dict(self.options),
+            "webhooks": self.responses,
+            "failed_webhooks": self.errors,
+            "webhooks_per_sec": self.responses / http_elapsed,
+            "irc_lines": lines,
+            "irc_lines_per_sec": lines / elapsed,
+            "lost_messages": len(self.sent),
+            "latency_p50": percentile(self.latencies, 0.5),
+            "latency_p99": percentile(self.latencies, 0.99),
+            "latency_max": max(self.latencies or [None]),
+            "flood_kills": sum(f.flood_kills for f in self.irc_factories),
+            "overlong_lines": sum(f.overlong_lines
+                                  for f in self.irc_factories),
+            "peak_rss_kib": peak_rss_kib(),
+        }
+
+
+def main(argv=None):
+    options = LoadTestOptions()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError, e:
+        sys.stderr.write("%s\n%s\n" % (options, e))
+        sys.exit(2)
+    reports = []
+
+    def run():
+        d = LoadTest(options).run()
+        d.addCallback(reports.append)
+        d.addErrback(failed)
+        d.addBoth(lambda _: reactor.stop())
+
+    def failed(failure):
+        if failure.check(JoinTimeout):
+            sys.stderr.write("%s\n" % (failure.getErrorMessage(), ))
+        else:
+            failure.printTraceback()
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+    if not reports:
+        sys.exit(1)
+    report = json.dumps(reports[0], indent=2, sort_keys=True)
+    if options["output"]:
+        with open(options["output"], "w") as output:
+            output.write(report + "\n")
+    else:
+        print report
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+# encoding: utf-8
+
+"""
+    Microbenchmarks for the code that runs for every commit and every
+    request, with a regression gate. Run it with::
+
+        python -m trompet.benchmarks.micro --save-baseline
+        python -m trompet.benchmarks.micro --threshold 0.2
+
+    The first command stores the results as baseline, the second one
+    exits with status 1 if a benchmark got more than 20% slower than the
+    baseline. Timings depend on the machine, so only compare results
+    from the same machine. Allocations are measured if the `tracemalloc`
+    module (or its Python 2 backport, pytracemalloc) is available.
+"""
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+import gc
+import os
+import string
+import sys
+import timeit
+
+from twisted.python import usage
+from twisted.web.resource import Resource
+from twisted.web.test.requesthelper import DummyRequest
+
+from trompet.listeners.webhook import (
+    TravisCIWebhookListener, WebhookListener, extract_bitbucket_commit,
+    extract_github_commit, short_commit_message)
+from trompet.service import Project
+from trompet.web import ProjectsListing
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+MESSAGE_FORMAT = string.Template(
+    "$author committed rev $revision to $project/$branch: $shortmessage - $url")
+
+
+def commit_message(size):
+    "Returns a commit message of roughly `size` characters."
+    body = (u"Lörem ipsum dolor sit amet, consectetur adipiscing elit. "
+            * (size // 57 + 1))
+    return u"Fix the frobnicator\n\n" + body[:size]
+
+def github_payload(number_of_commits, message_size):
+    message = commit_message(message_size)
+    return {
+        "ref": "refs/heads/master",
+        "commits": [{"id": "%040x" % (i, ),
+                     "message": message,
+                     "url": "https://github.com/example/project/commit/%i"
+                            % (i, ),
+                     "author": {"name": u"Jörg Example"}}
+                    for i in xrange(number_of_commits)]
+    }
+
+def bitbucket_payload(number_of_commits, message_size):
+    message = commit_message(message_size)
+    return {
+        "repository": {"absolute_url": "/example/project/"},
+        "commits": [{"node": "%012x" % (i, ), "message": message,
+                     "author": u"Jörg Example", "branch": "default"}
+                    for i in xrange(number_of_commits)]
+    }
+
+#: name: (number of commits, message size)
+FIXTURES = {
+    "tiny": (1, 10),
+    "typical": (3, 300),
+    "10k-commits": (10000, 300),
+    "huge-message": (1, 1024 * 1024),
+}
+
+
+class NullObserver(object):
+    def notify(self, project, message):
+        pass
+
+class FakeTrompet(object):
+    def __init__(self):
+        self.projects = {}
+        self.shards = None
+
+
+def payload_request(payload):
+    request = DummyRequest([b"/"])
+    request.method = "POST"
+    request.args["payload"] = [json.dumps(payload)]
+    return request
+
+def bench_extract_github_commit(fixture):
+    payload = github_payload(*fixture)
+    def run():
+        for data in payload["commits"]:
+            extract_github_commit(payload, data)
+    return run
+
+def bench_extract_bitbucket_commit(fixture):
+    payload = bitbucket_payload(*fixture)
+    def run():
+        for data in payload["commits"]:
+            extract_bitbucket_commit(payload, data)
+    return run
+
+def bench_short_commit_message(fixture):
+    messages = [commit_message(fixture[1])] * fixture[0]
+    def run():
+        for message in messages:
+            short_commit_message(message)
+    return run
+
+def bench_webhook_render_post(fixture):
+    listener = WebhookListener("project", NullObserver(), MESSAGE_FORMAT,
+                               extract_github_commit)
+    payload = github_payload(*fixture)
+    def run():
+        listener.render_POST(payload_request(payload))
+    return run
+
+def bench_travisci_extract_buildinfo(fixture):
+    listener = TravisCIWebhookListener("project", NullObserver(),
+                                       MESSAGE_FORMAT, "token")
+    payload = {"author_name": u"Jörg Example", "commit": "%040x" % (1, ),
+               "message": commit_message(fixture[1]),
+               "compare_url": "https://github.com/example/compare",
+               "branch": "master", "status_message": "Passed",
+               "build_url": "https://travis-ci.org/example/builds/1"}
+    def run():
+        for _ in xrange(fixture[0]):
+            listener._extract_buildinfo(payload)
+    return run
+
+def bench_projects_listing(fixture):
+    # Interpreted as (number of projects, unused)
+    trompet = FakeTrompet()
+    for i in xrange(fixture[0]):
+        project = Project(u"project %i" % (i, ), "token%i" % (i, ), {},
+                          Resource())
+        project.listeners = [u"bitbucket", u"github", u"travisci", u"xmlrpc"]
+        for name in project.listeners:
+            project.resource.putChild(str(name), Resource())
+        trompet.projects[project.name] = project
+    listing = ProjectsListing(trompet)
+    request = DummyRequest([b"projects"])
+    request.prePathURL = lambda: "http://trompet.example.org/projects"
+    def run():
+        listing.render_GET(request)
+    return run
+
+BENCHMARKS = {
+    "extract_github_commit": bench_extract_github_commit,
+    "extract_bitbucket_commit": bench_extract_bitbucket_commit,
+    "short_commit_message": bench_short_commit_message,
+    "WebhookListener.render_POST": bench_webhook_render_post,
+    "TravisCIWebhookListener._extract_buildinfo":
+        bench_travisci_extract_buildinfo,
+    "ProjectsListing.render_GET": bench_projects_listing,
+}
+
+
+def measure(function, repeat=5, min_time=0.2):
+    """Returns a dict with the best time per call in seconds (the minimum
+    of `repeat` runs, each running at least `min_time` seconds) and, if
+    `tracemalloc` is available, the peak of allocated bytes per call.
+    """
+    timer = timeit.Timer(function)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    result = {"seconds": min(timer.repeat(repeat, number)) / number}
+    if tracemalloc is not None:
+        gc.collect()
+        tracemalloc.start()
+        function()
+        result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+def run_benchmarks(names=None, fixtures=None, **measure_options):
+    """Runs the benchmarks and returns a dict mapping
+    ``<benchmark>/<fixture>`` to the measured results.
+    """
+    results = {}
+    for name in sorted(names or BENCHMARKS):
+        for fixture in sorted(fixtures or FIXTURES):
+            function = BENCHMARKS[name](FIXTURES[fixture])
+            results["%s/%s" % (name, fixture)] = measure(function,
+                                                         **measure_options)
+    return results
+
+def compare(results, baseline, threshold):
+    """Returns a list of (name, metric, ratio) for all results whose time
+    or allocations are more than `threshold` (a fraction) above the
+    baseline.
+    """
+    regressions = []
+    for (name, result) in sorted(results.iteritems()):
+        for metric in ["seconds", "peak_bytes"]:
+            if metric not in result or metric not in baseline.get(name, {}):
+                continue
+            ratio = float(result[metric]) / max(baseline[name][metric], 1e-12)
+            if ratio > 1 + threshold:
+                regressions.append((name, metric, ratio))
+    return regressions
+
+
+class MicroOptions(usage.Options):
+    optFlags = [
+        ["save-baseline", None, "Store the results as new baseline."],
+    ]
+    optParameters = [
+        ["baseline", None, DEFAULT_BASELINE, "Path of the baseline file."],
+        ["threshold", None, 0.2,
+         "Maximum allowed slowdown (0.2 means 20%).", float],
+        ["repeat", None, 5, "Number of timing runs per benchmark.", int],
+        ["benchmark", "b", None, "Only run the benchmarks with this name."],
+        ["fixture", "f", None, "Only use this fixture."],
+    ]
+
+
+def main(argv=None):
+    options = MicroOptions()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError, e:
+        sys.stderr.write("%s\n%s\n" % (options, e))
+        sys.exit(2)
+    results = run_benchmarks(
+        options["benchmark"] and [options["benchmark"]],
+        options["fixture"] and [options["fixture"]],
+        repeat=options["repeat"])
+    for (name, result) in sorted(results.iteritems()):
+        print "%-60s %12.3f us" % (name, result["seconds"] * 1e6)
+    if options["save-baseline"]:
+        with open(options["baseline"], "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        return
+    try:
+        with open(options["baseline"]) as baseline_file:
+            baseline = json.load(baseline_file)
+    except IOError:
+        print "No baseline found, run with --save-baseline to store one."
+        return
+    regressions = compare(results, baseline, options["threshold"])
+    for (name, metric, ratio) in regressions:
+        print "REGRESSION: %s: %s %.0f%% above baseline" % (
+            name, metric, (ratio - 1) * 100)
+    if regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+# encoding: utf-8
+
+"""
+    Replays captured webhook traffic (see `trompet.capture`) against a
+    running trompet, e.g. one that is connected to fake IRC servers.
+    Run it with::
+
+        python -m trompet.benchmarks.replay --config config.json \\
+            --url http://localhost:8080/ --speed 10 capture-*.jsonl.gz
+
+    Captures don't contain tokens or secrets, so they are taken from the
+    target's configuration: requests are sent to the token of the project
+    with the recorded name, and Travis CI requests get an
+    ``Authorization`` header computed from the target's Travis CI token.
+    ``--speed 1`` replays in real time, ``--speed N`` N times faster and
+    ``--speed 0`` as fast as possible.
+"""
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import os
+import sys
+import time
+from hashlib import sha256
+from StringIO import StringIO
+
+from twisted.internet import defer, reactor, task
+from twisted.python import usage
+from twisted.web.client import (Agent, FileBodyProducer, HTTPConnectionPool,
+                                readBody)
+from twisted.web.http_headers import Headers
+
+from trompet.capture import capture_files, read_captures
+
+
+class ReplayOptions(usage.Options):
+    optParameters = [
+        ["config", "c", None, "Configuration of the target trompet."],
+        ["url", "u", "http://localhost:8080/", "Base URL of the target."],
+        ["speed", "s", 1.0, "Replay speed (0: as fast as possible).", float],
+        ["concurrency", None, 10,
+         "Maximum number of parallel requests at maximum speed.", int],
+    ]
+
+    def parseArgs(self, *paths):
+        self["paths"] = []
+        for path in paths:
+            if os.path.isdir(path):
+                self["paths"].extend(capture_files(path))
+            else:
+                self["paths"].append(path)
+
+    def postOptions(self):
+        if self["config"] is None:
+            raise usage.UsageError("--config is required")
+        if not self["paths"]:
+            raise usage.UsageError("No capture files given")
+
+
+class Replayer(object):
+    def __init__(self, config, base_url, speed=1.0, concurrency=10):
+        self.projects = config["projects"]
+        self.base_url = base_url.rstrip("/") + "/"
+        self.speed = speed
+        self.semaphore = defer.DeferredSemaphore(concurrency)
+        self.pool = HTTPConnectionPool(reactor)
+        self.agent = Agent(reactor, pool=self.pool)
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+
+    @defer.inlineCallbacks
+    def replay(self, records):
+        """Sends the given records, keeping their relative timing
+        (scaled by the speed). Returns a Deferred that fires with a
+        report.
+        """
+        started = time.time()
+        first_arrival = None
+        requests = []
+        for record in records:
+            if first_arrival is None:
+                first_arrival = record["time"]
+            if self.speed:
+                due = (record["time"] - first_arrival) / self.speed
+                delay = due - (time.time() - started)
+                if delay > 0:
+                    yield task.deferLater(reactor, delay, lambda: None)
+                requests.append(self._send(record))
+            else:
+                d = self.semaphore.run(self._send, record)
+                requests.append(d)
+                # Don't read the whole capture into memory
+                if self.semaphore.tokens == 0:
+                    yield self.semaphore.acquire()
+                    self.semaphore.release()
+        yield defer.DeferredList(requests)
+        elapsed = time.time() - started
+        yield self.pool.closeCachedConnections()
+        defer.returnValue({
+            "sent": self.sent,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "elapsed": elapsed,
+            "requests_per_sec": self.sent / elapsed if elapsed else None,
+        })
+
+    def _send(self, record):
+        project = self.projects.get(record["project"])
+        if project is None:
+            self.skipped += 1
+            return defer.succeed(None)
+        headers = Headers()
+        for (name, value) in record["headers"]:
+            if name.lower() not in ["content-length", "host"]:
+                headers.addRawHeader(name.encode("ascii"),
+                                     value.encode("latin-1"))
+        slug = headers.getRawHeaders("Travis-Repo-Slug")
+        if slug and "travisci" in project:
+            travis_token = project["travisci"]["token"]
+            headers.setRawHeaders("Authorization", [
+                sha256(slug[0] + travis_token.encode("utf-8")).hexdigest()])
+        url = "%s%s/%s" % (self.base_url, project["token"], record["path"])
+        body = FileBodyProducer(StringIO(record["body"]))
+        d = self.agent.request(record["method"].encode("ascii"),
+                               url.encode("utf-8"), headers, body)
+        d.addCallback(self._response_received)
+        d.addErrback(self._request_failed)
+        return d
+
+    def _response_received(self, response):
+        if 200 <= response.code < 300:
+            self.sent += 1
+        else:
+            self.failed += 1
+        return readBody(response)
+
+    def _request_failed(self, failure):
+        self.failed += 1
+
+
+def main(argv=None):
+    options = ReplayOptions()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError, e:
+        sys.stderr.write("%s\n%s\n" % (options, e))
+        sys.exit(2)
+    with open(options["config"]) as config_file:
+        config = json.load(config_file)
+    reports = []
+
+    def run():
+        replayer = Replayer(config, options["url"], options["speed"],
+                            options["concurrency"])
+        d = replayer.replay(read_captures(options["paths"]))
+        d.addCallback(reports.append)
+        d.addErrback(lambda failure: failure.printTraceback())
+        d.addBoth(lambda _: reactor.stop())
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+    if not reports:
+        sys.exit(1)
+    print json.dumps(reports[0], indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
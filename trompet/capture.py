@@ -0,0 +1,119 @@
+# encoding: utf-8
+
+"""
+    Capturing of inbound listener requests, for replaying real traffic
+    later (see `trompet.benchmarks.replay`).
+
+    Captures are gzip-compressed files with one JSON object per line.
+    Every object describes one request: ``time`` (arrival time as UNIX
+    timestamp), ``method``, ``project`` (the project's name, the token is
+    never stored), ``path`` (the path below the project's token),
+    ``headers`` (a list of ``[name, value]`` pairs, secrets removed) and
+    ``body`` (base64).
+"""
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import base64
+import glob
+import gzip
+import os
+import time
+
+
+#: Headers that are never written to a capture file (lowercase).
+REDACTED_HEADERS = frozenset(["authorization", "cookie",
+                              "proxy-authorization"])
+
+#: Neither are headers whose (lowercase) name contains one of these, e.g.
+#: ``X-Hub-Signature-256`` or ``X-Gitlab-Token``.
+REDACTED_WORDS = ("token", "signature", "secret", "password")
+
+
+def is_redacted(name):
+    "Returns whether the header `name` must not be recorded."
+    name = name.lower()
+    return (name in REDACTED_HEADERS or
+            any(word in name for word in REDACTED_WORDS))
+
+
+class CaptureWriter(object):
+    """
+    Writes captured requests into rotated capture files in `directory`.
+    A new file is started once the current one holds more than
+    `max_file_size` bytes of (uncompressed) records; only the newest
+    `max_files` files are kept.
+    """
+
+    def __init__(self, directory, max_file_size=10 * 1024 * 1024,
+                 max_files=10):
+        self.directory = directory
+        self.max_file_size = max_file_size
+        self.max_files = max_files
+        self._file = None
+        self._size = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def capture(self, project, request):
+        "Records `request`, which was received for `project`."
+        raw_headers = request.requestHeaders.getAllRawHeaders()
+        headers = [[name, value] for (name, values) in raw_headers
+                   if not is_redacted(name) for value in values]
+        content = request.content
+        content.seek(0)
+        body = content.read()
+        content.seek(0)
+        record = {
+            "time": time.time(),
+            "method": request.method,
+            "project": project.name,
+            "path": "/".join(request.postpath[1:]),
+            "headers": headers,
+            "body": base64.b64encode(body),
+        }
+        self.write(json.dumps(record) + "\n")
+
+    def write(self, line):
+        if self._file is None or self._size > self.max_file_size:
+            self._rotate()
+        self._file.write(line)
+        # Flush every record, so that a crash doesn't lose the capture
+        self._file.flush()
+        self._size += len(line)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _rotate(self):
+        self.close()
+        name = "capture-%.6f.jsonl.gz" % (time.time(), )
+        self._file = gzip.open(os.path.join(self.directory, name), "wb")
+        self._size = 0
+        for path in capture_files(self.directory)[:-self.max_files]:
+            os.remove(path)
+
+
+def capture_files(directory):
+    "Returns the capture files in `directory`, oldest first."
+    return sorted(glob.glob(os.path.join(directory, "capture-*.jsonl.gz")))
+
+def read_captures(paths):
+    "Yields the recorded requests of the given capture files in order."
+    for path in paths:
+        capture_file = gzip.open(path, "rb")
+        try:
+            for line in capture_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Truncated last record of a crashed trompet
+                    break
+                record["body"] = base64.b64decode(record["body"])
+                yield record
+        finally:
+            capture_file.close()
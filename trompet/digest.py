@@ -0,0 +1,75 @@
+# encoding: utf-8
+
+"""
+    Digest mode for busy channels: instead of every message, a channel
+    gets one summary per interval with the number of messages per
+    project and the latest few messages. The memory needed doesn't
+    depend on the number of messages: only counters and the latest
+    messages are kept.
+"""
+
+import re
+from collections import Counter, deque
+
+
+class ChannelDigest(object):
+    """
+    Collects the messages of a channel. Messages matching one of the
+    regular expressions in `priority` are not collected but should be
+    sent immediately.
+    """
+
+    def __init__(self, interval=300, latest=3, max_projects=5,
+                 priority=None):
+        self.interval = interval
+        self.latest = latest
+        self.max_projects = max_projects
+        self.priority = [re.compile(pattern) for pattern in priority or ()]
+        self._counts = Counter()
+        self._latest = deque(maxlen=latest)
+
+    def __len__(self):
+        return sum(self._counts.itervalues())
+
+    def add(self, project_name, message):
+        """Collects a message. Returns `False` if it has priority and
+        should be sent immediately instead.
+        """
+        if any(pattern.search(message) for pattern in self.priority):
+            return False
+        self._counts[project_name] += 1
+        lines = message.splitlines()
+        self._latest.append((project_name, lines[0] if lines else u""))
+        return True
+
+    def flush(self):
+        """Returns the digest of the collected messages as one message and
+        starts over. Returns `None` if nothing was collected.
+        """
+        if not self._counts:
+            return None
+        projects = self._counts.most_common()
+        listed = [u"%s: %i" % item for item in projects[:self.max_projects]]
+        if len(projects) > self.max_projects:
+            listed.append(u"%i more projects" %
+                          (len(projects) - self.max_projects, ))
+        lines = [u"Digest: %i messages in %s (%s)" % (
+            len(self), _format_interval(self.interval), u", ".join(listed))]
+        lines.extend(u"[%s] %s" % item for item in self._latest)
+        self._counts.clear()
+        self._latest.clear()
+        return u"\n".join(lines)
+
+    def get_state(self):
+        return {"counts": dict(self._counts),
+                "latest": [list(item) for item in self._latest]}
+
+    def set_state(self, state):
+        self._counts.update(state["counts"])
+        self._latest.extend(tuple(item) for item in state["latest"])
+
+
+def _format_interval(seconds):
+    if seconds % 60 == 0:
+        return u"%i min" % (seconds // 60, )
+    return u"%g s" % (seconds, )
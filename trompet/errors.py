@@ -0,0 +1,5 @@
+# encoding: utf-8
+
+
+class ConfigurationError(Exception):
+    "Raised when there is an error in the configuration."
@@ -0,0 +1,189 @@
+# encoding: utf-8
+
+"""
+    Bounded per-project history of recent events (announced or omitted
+    commits and builds), so that one can check what trompet saw.
+
+    Every project has a ring buffer with a fixed number of slots. Events
+    are stored as small `__slots__` records with truncated fields and
+    interned author and branch names, so the memory needed is bounded by
+    the number of slots, no matter how much traffic there is. The buffer
+    can optionally be backed by a memory-mapped file, so that the history
+    survives restarts.
+"""
+
+import mmap
+import os
+import struct
+import time
+
+
+#: Maximum length of the text fields (in UTF-8 encoded bytes).
+FIELD_SIZES = [("revision", 64), ("author", 64), ("branch", 128),
+               ("message", 256)]
+
+# File layout: header, then one slot per event. A slot holds the time,
+# the "announced" flag and the length of every field, followed by the
+# fields padded to their maximum sizes.
+_HEADER = struct.Struct("<8sII")
+_MAGIC = "trompetH"
+_SLOT_HEADER = struct.Struct("<dB" + "H" * len(FIELD_SIZES))
+_SLOT_SIZE = _SLOT_HEADER.size + sum(size for (_, size) in FIELD_SIZES)
+
+
+def _truncate(text, size):
+    "Truncates `text` to `size` bytes of UTF-8, on a character boundary."
+    if text is None:
+        return None
+    if not isinstance(text, unicode):
+        text = str(text).decode("utf-8", "replace")
+    data = text.encode("utf-8")
+    if len(data) <= size:
+        return text
+    return data[:size].decode("utf-8", "ignore")
+
+
+class Event(object):
+    __slots__ = ["time", "announced", "revision", "author", "branch",
+                 "message"]
+
+    def __init__(self, time, announced, revision, author, branch, message):
+        self.time = time
+        self.announced = announced
+        self.revision = revision
+        self.author = author
+        self.branch = branch
+        self.message = message
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class EventHistory(object):
+    """
+    Ring buffer of the last `size` events of a project. If `path` is
+    given, the events are also stored in a memory-mapped file at that
+    path and loaded from it on creation.
+    """
+
+    def __init__(self, size, path=None):
+        self.size = size
+        self._events = [None] * size
+        self._next = 0
+        self._strings = {}
+        self._mmap = None
+        if path is not None:
+            self._open(path)
+
+    def __len__(self):
+        return sum(1 for event in self._events if event is not None)
+
+    def record(self, commit, announced=True, now=None):
+        """Stores an event for the given commit object (see
+        `trompet.listeners.webhook`).
+        """
+        if now is None:
+            now = time.time()
+        fields = [_truncate(commit.get(name), size)
+                  for (name, size) in FIELD_SIZES]
+        if "shortmessage" in commit:
+            fields[-1] = _truncate(commit["shortmessage"], FIELD_SIZES[-1][1])
+        index = self._next
+        self._store(index, Event(now, bool(announced), *fields))
+        self._next = (index + 1) % self.size
+        if self._mmap is not None:
+            self._write_slot(index, self._events[index])
+            _HEADER.pack_into(self._mmap, 0, _MAGIC, self.size, self._next)
+
+    def query(self, branch=None, author=None, since=None, limit=None):
+        """Returns the matching events, newest first."""
+        result = []
+        for i in xrange(self.size):
+            event = self._events[(self._next - 1 - i) % self.size]
+            if event is None:
+                break
+            if since is not None and event.time < since:
+                break
+            if branch is not None and event.branch != branch:
+                continue
+            if author is not None and event.author != author:
+                continue
+            result.append(event)
+            if limit is not None and len(result) >= limit:
+                break
+        return result
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _store(self, index, event):
+        # Intern authors and branches: there are only a few of them, but
+        # they repeat in nearly every event.
+        event.author = self._intern(event.author)
+        event.branch = self._intern(event.branch)
+        self._events[index] = event
+
+    def _intern(self, text):
+        if text is None:
+            return None
+        if len(self._strings) > 2 * self.size:
+            # Forget strings that are no longer used by any event
+            self._strings = {}
+            for event in self._events:
+                if event is not None:
+                    for value in [event.author, event.branch]:
+                        if value is not None:
+                            self._strings[value] = value
+        return self._strings.setdefault(text, text)
+
+    def _open(self, path):
+        length = _HEADER.size + self.size * _SLOT_SIZE
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            if os.fstat(fd).st_size != length:
+                # New file, or one for a different size: start over
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, length)
+            self._mmap = mmap.mmap(fd, length)
+        finally:
+            os.close(fd)
+        (magic, size, next_index) = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC or size != self.size or next_index >= size:
+            _HEADER.pack_into(self._mmap, 0, _MAGIC, self.size, 0)
+            return
+        self._next = next_index
+        for index in xrange(self.size):
+            event = self._read_slot(index)
+            if event is not None:
+                self._store(index, event)
+
+    def _slot_offset(self, index):
+        return _HEADER.size + index * _SLOT_SIZE
+
+    def _write_slot(self, index, event):
+        offset = self._slot_offset(index)
+        values = [getattr(event, name) for (name, _) in FIELD_SIZES]
+        encoded = [(value or u"").encode("utf-8") for value in values]
+        _SLOT_HEADER.pack_into(self._mmap, offset, event.time,
+                               event.announced,
+                               *[len(data) for data in encoded])
+        offset += _SLOT_HEADER.size
+        for ((_, size), data) in zip(FIELD_SIZES, encoded):
+            self._mmap[offset:offset + len(data)] = data
+            offset += size
+
+    def _read_slot(self, index):
+        offset = self._slot_offset(index)
+        values = _SLOT_HEADER.unpack_from(self._mmap, offset)
+        (event_time, announced) = values[:2]
+        if not event_time:
+            return None
+        offset += _SLOT_HEADER.size
+        fields = []
+        for ((_, size), length) in zip(FIELD_SIZES, values[2:]):
+            fields.append(self._mmap[offset:offset + min(length, size)]
+                          .decode("utf-8", "replace") or None)
+            offset += size
+        return Event(event_time, bool(announced), *fields)
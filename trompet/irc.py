@@ -1,29 +1,140 @@
+# encoding: utf-8
+
 from twisted.internet import protocol
 from twisted.words.protocols import irc
 
+
+#: Maximum length of a line in the IRC protocol in bytes, including the
+#: trailing CR-LF.
+MAX_LINE_LENGTH = 512
+
+#: What we assume for the "user@host" part of our own hostmask until the
+#: server told us the real one: 10 bytes for the user name (based on
+#: observation) and 63 bytes for the hostname (RFC 2812, section 2.3.1).
+_WORST_CASE_USERHOST = "%s@%s" % ("u" * 10, "h" * 63)
+
+
+def _encode(text):
+    if isinstance(text, unicode):
+        return text.encode("utf-8")
+    return text
+
+def _utf8_chunks(line, max_bytes):
+    """Split a UTF-8 encoded line into chunks of at most `max_bytes`
+    bytes. Splits at whitespace if there is some in the second half of
+    a chunk, but never inside a multi-byte character.
+    """
+    while len(line) > max_bytes:
+        cut = max_bytes
+        # Don't split a character: move back to the start of the
+        # character (continuation bytes look like 0b10xxxxxx)
+        while cut > 0 and (ord(line[cut]) & 0xC0) == 0x80:
+            cut -= 1
+        if cut == 0:
+            raise ValueError("Maximum length too small for a character")
+        space = line.rfind(" ", 0, cut + 1)
+        if space > max_bytes // 2:
+            (chunk, line) = (line[:space], line[space + 1:])
+        else:
+            (chunk, line) = (line[:cut], line[cut:])
+        yield chunk
+    if line:
+        yield line
+
+def pack_lines(lines, max_bytes, separator=None):
+    """Given an iterable of (logical) lines, return a generator that
+    yields protocol lines whose UTF-8 encoding is at most `max_bytes`
+    long. Lines that are too long are split on character boundaries.
+
+    If a `separator` is given, several short lines are packed into one
+    protocol line, joined by `separator`. Empty lines are dropped.
+    """
+    separator = _encode(separator)
+    packed = []
+    size = 0
+    for line in lines:
+        for chunk in _utf8_chunks(_encode(line), max_bytes):
+            if separator is None:
+                yield chunk.decode("utf-8", "replace")
+            elif packed and size + len(separator) + len(chunk) <= max_bytes:
+                packed.append(chunk)
+                size += len(separator) + len(chunk)
+            else:
+                if packed:
+                    yield separator.join(packed).decode("utf-8", "replace")
+                packed = [chunk]
+                size = len(chunk)
+    if packed:
+        yield separator.join(packed).decode("utf-8", "replace")
+
+
 class IRCBot(irc.IRCClient):
     encoding = "utf8"
     nickname = property(lambda self: self.factory.nickname)
     password = property(lambda self: self.factory.password)
+    userhost = None
+    signed_on = False
 
     def sendLine(self, line):
         if isinstance(line, unicode):
             line = line.encode(self.encoding)
         return irc.IRCClient.sendLine(self, line)
 
+    def line_budget(self, command):
+        """Return the number of bytes that are available for the
+        argument of `command` once the server relayed it, i.e. prefixed
+        it with our hostmask.
+        """
+        hostmask = "%s!%s" % (_encode(self.nickname),
+                              self.userhost or _WORST_CASE_USERHOST)
+        # ":<hostmask> <command><argument>\r\n"
+        overhead = len(hostmask) + len(_encode(command)) + 4
+        return MAX_LINE_LENGTH - overhead
+
+    def msg(self, user, message, length=None):
+        """Send a message to a user or channel. Unlike
+        `irc.IRCClient.msg`, the message is split by its UTF-8 encoded
+        size and short lines are packed into one protocol line if the
+        network has a line separator configured.
+        """
+        command = "PRIVMSG %s :" % (user, )
+        if length is None:
+            budget = self.line_budget(command)
+        else:
+            budget = length - len(_encode(command)) - 2
+        if budget <= 0:
+            raise ValueError("Maximum length too small for message to %s"
+                             % (user, ))
+        lines = _encode(message).splitlines()
+        for line in pack_lines(lines, budget, self.factory.line_separator):
+            self.sendLine(command + line)
+
+    def irc_JOIN(self, prefix, params):
+        (nick, _, userhost) = prefix.partition("!")
+        if nick == self.nickname and userhost:
+            self.userhost = userhost
+        irc.IRCClient.irc_JOIN(self, prefix, params)
+
     def signedOn(self):
         self.factory.resetDelay()
         if self.factory.nickserv_pw:
             self.msg("NickServ", "IDENTIFY " + self.factory.nickserv_pw)
         for channel in self.factory.channels:
             self.join(channel)
+        self.signed_on = True
+        # Send what was queued while we were not connected
+        self.factory.service.flush_queue(self.factory.network)
+
+    def connectionLost(self, reason):
+        self.signed_on = False
+        irc.IRCClient.connectionLost(self, reason)
 
 
 class IRCFactory(protocol.ReconnectingClientFactory):
     protocol = IRCBot
 
     def __init__(self, service, network, nickname, channels=None,
-                 nickserv_pw=None, password=None):
+                 nickserv_pw=None, password=None, line_separator=None):
         if channels is None:
             channels = []
         self.service = service
@@ -32,9 +143,10 @@ class IRCFactory(protocol.ReconnectingClientFactory):
         self.channels = channels
         self.nickserv_pw = nickserv_pw
         self.password = password
+        self.line_separator = line_separator
 
     def reconfigure(self, bot, nickname, channels=None, nickserv_pw=None,
-                    password=None):
+                    password=None, line_separator=None):
         if nickname != self.nickname:
             bot.setNick(nickname)
             self.nickname = nickname
@@ -42,6 +154,7 @@ class IRCFactory(protocol.ReconnectingClientFactory):
             self.nickserv_pw = nickserv_pw
         if password != self.password:
             self.password = password
+        self.line_separator = line_separator
         new_channels = set(channels or None)
         current_channels = set(self.channels)
         to_join = new_channels - current_channels
@@ -1,3 +1,8 @@
 from trompet.listeners._registry import registry
 
-from trompet.listeners import webhook, xmlrpc
+# The built-in listeners are only imported when a project uses them
+registry.register_lazy(u"bitbucket", "trompet.listeners.webhook")
+registry.register_lazy(u"github", "trompet.listeners.webhook")
+registry.register_lazy(u"travisci", "trompet.listeners.webhook")
+registry.register_lazy(u"unix", "trompet.listeners.unix")
+registry.register_lazy(u"xmlrpc", "trompet.listeners.xmlrpc")
@@ -1,14 +1,117 @@
 # encoding: utf-8
 
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import os
+import sys
+
+
+#: setuptools entry point group for third-party listeners. Each entry
+#: point's name is the listener's config setting, and it points to the
+#: listener factory (``name = module:attribute``). If the attribute is
+#: omitted, the module is expected to register its factory itself.
+ENTRY_POINT_GROUP = "trompet.listeners"
+
+
+def _default_cache_path():
+    cache_home = os.environ.get("XDG_CACHE_HOME",
+                                os.path.expanduser("~/.cache"))
+    return os.path.join(cache_home, "trompet", "listeners.json")
+
+def _sys_path_fingerprint():
+    """Returns something that changes whenever a distribution is
+    installed, removed or its entry points change: the mtimes of the
+    `sys.path` entries (installing touches the directory) and of the
+    distributions' metadata, including their ``entry_points.txt``
+    (rewritten by ``egg_info`` in develop installs).
+    """
+    fingerprint = []
+    for path in sys.path:
+        path = path or "."
+        try:
+            fingerprint.append([path, os.stat(path).st_mtime])
+            names = sorted(os.listdir(path))
+        except OSError:
+            continue
+        for name in names:
+            if not name.endswith((".egg-info", ".dist-info")):
+                continue
+            metadata_path = os.path.join(path, name)
+            entry_points_path = os.path.join(metadata_path, "entry_points.txt")
+            for candidate in [metadata_path, entry_points_path]:
+                try:
+                    fingerprint.append([candidate,
+                                        os.stat(candidate).st_mtime])
+                except OSError:
+                    pass
+    return fingerprint
+
+def _scan_entry_points():
+    "Returns a dict mapping listener names to ``module:attribute`` specs."
+    # Importing pkg_resources scans all installed distributions, so only
+    # do it when really needed.
+    import pkg_resources
+    index = {}
+    for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP):
+        spec = entry_point.module_name
+        if entry_point.attrs:
+            spec += ":" + ".".join(entry_point.attrs)
+        index.setdefault(entry_point.name, spec)
+    return index
+
+
+class _LazyListener(object):
+    """
+    Stands in for a listener factory whose module has not been imported
+    yet. The module is imported when the listener is used for the first
+    time.
+    """
+
+    def __init__(self, registry, name, spec):
+        self.registry = registry
+        self.name = name
+        self.spec = spec
+
+    def __repr__(self):
+        return "<_LazyListener(name=%r, spec=%r)>" % (self.name, self.spec)
+
+    def load(self):
+        "Imports the listener's module and returns the real factory."
+        (module_name, _, attrs) = self.spec.partition(":")
+        module = __import__(module_name, fromlist=["__name__"])
+        if attrs:
+            factory = module
+            for attr in attrs.split("."):
+                factory = getattr(factory, attr)
+            self.registry.services[self.name] = factory
+        else:
+            # The module registered the factory on import
+            factory = self.registry.services[self.name]
+            if factory is self:
+                raise ImportError("Module %r does not provide listener %r"
+                                  % (module_name, self.name))
+        return factory
+
+    def create(self, *args, **kwargs):
+        return self.load().create(*args, **kwargs)
+
+
 class _ServiceRegistry(object):
-    def __init__(self):
+    def __init__(self, cache_path=None):
         self.services = {}
+        self.cache_path = cache_path
+        self._discovered = False
 
     def get(self, name):
         """
         Return the handler for the given name. Raises `KeyError` if
-        the handler does not exist.
+        the handler does not exist. Handlers provided by plugins are
+        discovered on the first miss.
         """
+        if name not in self.services and not self._discovered:
+            self.discover()
         return self.services[name]
 
     def register(self, service):
@@ -16,9 +119,54 @@ class _ServiceRegistry(object):
         Register the given service. Returns the service so it can
         be used as decorator.
         """
-        if service.name in self.services:
+        registered = self.services.get(service.name)
+        if registered is not None and not isinstance(registered,
+                                                     _LazyListener):
             raise ValueError("Service %r already registered" % (service.name, ))
         self.services[service.name] = service
         return service
 
+    def register_lazy(self, name, spec):
+        """
+        Register the service `name`, to be imported from `spec`
+        (``module`` or ``module:attribute``) when it is used. Does
+        nothing if a service with that name is already registered.
+        """
+        if name not in self.services:
+            self.services[name] = _LazyListener(self, name, spec)
+
+    def discover(self):
+        """
+        Register the listeners provided by plugins (see
+        `ENTRY_POINT_GROUP`) lazily. The entry points are read from an
+        on-disk index that is only rebuilt when the set of installed
+        distributions changed.
+        """
+        self._discovered = True
+        for (name, spec) in self._load_index().iteritems():
+            self.register_lazy(name, spec)
+
+    def _load_index(self):
+        cache_path = self.cache_path or _default_cache_path()
+        fingerprint = _sys_path_fingerprint()
+        try:
+            with open(cache_path) as cache_file:
+                cache = json.load(cache_file)
+            if cache["fingerprint"] == fingerprint:
+                return cache["listeners"]
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+        index = _scan_entry_points()
+        try:
+            directory = os.path.dirname(cache_path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(cache_path, "w") as cache_file:
+                json.dump({"fingerprint": fingerprint, "listeners": index},
+                          cache_file)
+        except (IOError, OSError):
+            # Not being able to write the cache only costs startup time
+            pass
+        return index
+
 registry = _ServiceRegistry()
@@ -0,0 +1,56 @@
+# encoding: utf-8
+
+"""
+    Helpers for announcing commits, shared by the listeners.
+"""
+
+from itertools import islice
+
+
+def short_commit_message(message):
+    "Returns the first line of a commit message."
+    lines = message.splitlines()
+    shortmessage = lines[0]
+    if len(lines) > 1:
+        shortmessage += u"…"
+    return shortmessage
+
+def complete_commit(commit):
+    """Adds the keys that can be derived from others (``shortmessage``)
+    to a commit object sent by a client. Returns the commit object.
+    """
+    if "shortmessage" not in commit and commit.get("message"):
+        commit["shortmessage"] = short_commit_message(commit["message"])
+    return commit
+
+def announce_commits(observer, project, message_format, commits,
+                     max_commits_per_push=None, history=None,
+                     commit_filter=None):
+    """Format the given commits with `message_format` and announce them
+    using `observer`. Announces at most `max_commits_per_push` commits
+    and a message with the number of omitted commits. All commits are
+    recorded in `history`, if given. If a `commit_filter` is given, its
+    routes decide the channels of each commit (filtering itself happens
+    before). Returns the number of omitted commits.
+    """
+    commits = iter(commits)
+    for commit in islice(commits, max_commits_per_push):
+        message = message_format.safe_substitute(commit, project=project)
+        channels = None
+        if commit_filter is not None:
+            channels = commit_filter.channels_for(commit)
+        if channels is None:
+            observer.notify(project, message)
+        else:
+            observer.notify(project, message, channels)
+        if history is not None:
+            history.record(commit)
+    omitted_commits = 0
+    for commit in commits:
+        omitted_commits += 1
+        if history is not None:
+            history.record(commit, announced=False)
+    if omitted_commits:
+        observer.notify(
+            project, "[%i commits omitted.]" % (omitted_commits, ))
+    return omitted_commits
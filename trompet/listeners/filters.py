@@ -0,0 +1,115 @@
+# encoding: utf-8
+
+"""
+    Filter rules for commits, compiled once when a listener is created
+    and checked right after a commit was extracted, before it is
+    formatted. The rules are part of a listener's configuration:
+
+    - branches: Only announce commits to branches matching one of these
+      glob patterns.
+    - ignore branches: Don't announce commits to these branches.
+    - authors: Only announce commits by these authors.
+    - ignore authors: Don't announce commits by these authors.
+    - paths: Only announce commits that touch a file matching one of
+      these glob patterns.
+    - routes: A list of objects with the keys ``branches`` (glob
+      patterns) and ``channels`` (like a project's channels). Commits
+      to a matching branch are only announced in the channels of the
+      first matching route.
+"""
+
+import fnmatch
+import re
+
+
+#: The config settings of a listener that belong to the filter.
+FILTER_SETTINGS = frozenset(["branches", "ignore branches", "authors",
+                             "ignore authors", "paths", "routes"])
+
+
+def compile_globs(patterns):
+    """Compiles a list of glob patterns into the `match` method of a
+    single regular expression. Returns `None` for an empty list.
+    """
+    if not patterns:
+        return None
+    regexes = []
+    for pattern in patterns:
+        regex = fnmatch.translate(pattern)
+        # Python 2.7 appends the flags, which must not be repeated inside
+        # a group
+        if regex.endswith("(?ms)"):
+            regex = regex[:-len("(?ms)")]
+        regexes.append("(?:%s)" % (regex, ))
+    return re.compile("|".join(regexes), re.S).match
+
+
+class CommitFilter(object):
+    """
+    Compiled filter rules (see the module's docstring).
+    """
+
+    def __init__(self, config, channels=None):
+        """
+        `config` is the listener's configuration, `channels` the
+        project's channels. Raises `ValueError` if a route uses a
+        channel that is not one of the project's channels.
+        """
+        self.match_branch = compile_globs(config.get("branches"))
+        self.match_ignored_branch = compile_globs(
+            config.get("ignore branches"))
+        self.authors = frozenset(config.get("authors") or ())
+        self.ignored_authors = frozenset(config.get("ignore authors") or ())
+        self.match_path = compile_globs(config.get("paths"))
+        self.routes = []
+        for route in config.get("routes") or ():
+            for (network, route_channels) in route["channels"].iteritems():
+                unknown = set(route_channels) - set(
+                    (channels or {}).get(network, ()))
+                if unknown:
+                    raise ValueError("Channels %s of network %r are not "
+                                     "configured for the project" %
+                                     (", ".join(sorted(unknown)), network))
+            self.routes.append(
+                (compile_globs(route["branches"]), route["channels"]))
+
+    def accepts(self, commit, get_paths=None):
+        """Returns whether the commit should be announced. `get_paths`
+        is called to get the paths touched by the commit, but only if
+        there are path rules.
+        """
+        author = commit.get("author")
+        if self.ignored_authors and author in self.ignored_authors:
+            return False
+        if self.authors and author not in self.authors:
+            return False
+        branch = commit.get("branch") or u""
+        if self.match_branch is not None and not self.match_branch(branch):
+            return False
+        if (self.match_ignored_branch is not None and
+            self.match_ignored_branch(branch)):
+            return False
+        if self.match_path is not None:
+            paths = get_paths() if get_paths is not None else ()
+            if not any(self.match_path(path) for path in paths):
+                return False
+        return True
+
+    def channels_for(self, commit):
+        """Returns the channels in which the commit should be announced,
+        or `None` for all of the project's channels.
+        """
+        branch = commit.get("branch") or u""
+        for (match, channels) in self.routes:
+            if match(branch):
+                return channels
+        return None
+
+
+def compile_filter(config, channels=None):
+    """Returns a `CommitFilter` for the listener configuration `config`,
+    or `None` if it has no filter rules.
+    """
+    if not isinstance(config, dict) or not FILTER_SETTINGS & set(config):
+        return None
+    return CommitFilter(config, channels)
@@ -0,0 +1,61 @@
+# encoding: utf-8
+
+"""
+    Listener for notifications sent through trompet's UNIX domain
+    socket (see `trompet.unix`).
+"""
+
+from trompet.errors import ConfigurationError
+from trompet.listeners import registry
+from trompet.listeners.commits import announce_commits, complete_commit
+from trompet.listeners.xmlrpc import message_settings
+
+
+class UnixSocketListener(object):
+    """
+    Handles a project's requests received on the UNIX socket.
+    """
+
+    def __init__(self, project, observer, message_format,
+                 max_commits_per_push=None, history=None):
+        self.project = project
+        self.observer = observer
+        self.message_format = message_format
+        self.max_commits_per_push = max_commits_per_push
+        self.history = history
+
+    def handle(self, request):
+        """Announce the request's ``message`` or ``commits``. Returns the
+        number of omitted commits.
+        """
+        if "message" in request:
+            self.observer.notify(self.project, request["message"])
+            if self.history is not None:
+                self.history.record({"message": request["message"]})
+            return 0
+        commits = request["commits"]
+        if not all(isinstance(commit, dict) for commit in commits):
+            raise TypeError("commits must be objects")
+        return announce_commits(
+            self.observer, self.project, self.message_format,
+            [complete_commit(commit) for commit in commits],
+            self.max_commits_per_push, self.history)
+
+class ListenerFactory(object):
+    name = u"unix"
+
+    def create(self, service, project, config, observer):
+        if not config:
+            return
+        if service.unix is None:
+            msg = "Project %r uses the UNIX socket, but none is configured"
+            raise ConfigurationError(msg % (project, ))
+        (message_format, max_commits_per_push) = message_settings(project,
+                                                               config)
+        token = service.projects[project].token
+        service.unix.listeners[token] = UnixSocketListener(
+            project, observer, message_format, max_commits_per_push,
+            service.get_history(project))
+
+listener_factory = ListenerFactory()
+registry.register(listener_factory)
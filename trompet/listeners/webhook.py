@@ -11,22 +11,32 @@ try:
     import json
 except ImportError:
     import simplejson as json
+import re
 import string
-from itertools import islice
+from collections import OrderedDict
 from hashlib import sha256
 
 from twisted.web import http, resource
 
+from trompet.errors import ConfigurationError
 from trompet.listeners import registry
+from trompet.listeners.commits import (announce_commits, complete_commit,
+                                       short_commit_message)
+from trompet.listeners.filters import FILTER_SETTINGS, compile_filter
 
 
-def short_commit_message(message):
-    "Returns the first line of a commit message."
-    lines = message.splitlines()
-    shortmessage = lines[0]
-    if len(lines) > 1:
-        shortmessage += u"…"
-    return shortmessage
+def get_payload(request):
+    """Returns the JSON payload of a webhook request: the ``payload`` form
+    field or, for ``application/json`` requests, the body. Returns `None`
+    if there is none.
+    """
+    if "payload" in request.args:
+        return request.args["payload"][0]
+    content_type = request.getHeader("Content-Type") or ""
+    if content_type.split(";")[0].strip().lower() == "application/json":
+        request.content.seek(0)
+        return request.content.read()
+    return None
 
 def extract_bitbucket_commit(payload, commit_data):
     """Given the payload from a message from bitbucket's POST service,
@@ -77,63 +87,163 @@ def extract_github_commit(payload, commit_data):
     commit["shortmessage"] = short_commit_message(commit["message"])
     return commit
 
+def extract_bitbucket_paths(payload, commit_data):
+    "Returns the paths of the files touched by a bitbucket commit."
+    return [data["file"] for data in commit_data.get("files", ())]
+
+def extract_github_paths(payload, commit_data):
+    "Returns the paths of the files touched by a GitHub commit."
+    paths = []
+    for key in ["added", "removed", "modified"]:
+        paths.extend(commit_data.get(key, ()))
+    return paths
+
 class WebhookListener(resource.Resource):
     """
     Resource waiting for a push notification.
     """
 
     def __init__(self, project, observer, message_format, commit_extractor,
-                 max_commits_per_push=None):
+                 max_commits_per_push=None, history=None, commit_filter=None,
+                 paths_extractor=None):
         resource.Resource.__init__(self)
         self.project = project
         self.observer = observer
         self.message_format = message_format
         self.extract_commit = commit_extractor
         self.max_commits_per_push = max_commits_per_push
+        self.history = history
+        self.commit_filter = commit_filter
+        self.extract_paths = paths_extractor
 
     def render_POST(self, request):
-        if "payload" not in request.args:
+        payload = get_payload(request)
+        if payload is None:
             request.setResponseCode(http.BAD_REQUEST)
             return ""
-        commits = self._parse_payload(request)
-        for commit in islice(commits, self.max_commits_per_push):
-            message = self.message_format.safe_substitute(
-                project=self.project, **commit)
-            self.observer.notify(self.project, message)
-        omitted_commits = sum(1 for _ in commits)
-        if omitted_commits:
-            self.observer.notify(
-                self.project, "[%i commits omitted.]" % (omitted_commits, ))
+        commits = self._parse_payload(request, payload)
+        announce_commits(self.observer, self.project, self.message_format,
+                         commits, self.max_commits_per_push, self.history,
+                         self.commit_filter)
         return ""
 
-    def _parse_payload(self, request):
+    def _parse_payload(self, request, payload):
         """Parses the request's payload.
 
         Returns a generator that yields commits. Sets the response code to
         400 (bad request) if the payload is malformed.
         """
         try:
-            payload = json.loads(request.args["payload"][0])
+            payload = json.loads(payload)
             for data in payload["commits"]:
-                yield self.extract_commit(payload, data)
+                commit = self.extract_commit(payload, data)
+                if (self.commit_filter is None or
+                    self.commit_filter.accepts(commit,
+                                               self._paths_getter(payload,
+                                                                  data))):
+                    yield commit
         except (KeyError, ValueError):
             request.setResponseCode(http.BAD_REQUEST)
 
+    def _paths_getter(self, payload, data):
+        if self.extract_paths is None:
+            return None
+        return lambda: self.extract_paths(payload, data)
+
+
+#: Maps Travis CI status messages to the build states that are compared
+#: to find transitions. `None` means the status doesn't change the state.
+BUILD_STATES = {
+    u"Pending": None,
+    u"Passed": u"passing",
+    u"Fixed": u"passing",
+    u"Broken": u"failing",
+    u"Failed": u"failing",
+    u"Still Failing": u"failing",
+    u"Errored": u"errored",
+    u"Canceled": u"canceled",
+}
+
+SUMMARY_MESSAGE = string.Template(
+    u"Travis CI: $count more builds for $project/$branch, still $state.")
+
+
+class BuildStates(object):
+    """
+    The last build state of every branch of a project, for announcing only
+    transitions (e.g. passing → failing). Only the `max_branches` most
+    recently built branches are remembered. If `summary_after` is given,
+    `update` asks for a summary after that many suppressed builds of a
+    branch.
+    """
+
+    def __init__(self, max_branches=1000, summary_after=None):
+        self.max_branches = max_branches
+        self.summary_after = summary_after
+        # Maps branches to [state, number of suppressed builds]
+        self._branches = OrderedDict()
+
+    def __len__(self):
+        return len(self._branches)
+
+    def update(self, branch, statusmessage):
+        """Records a build. Returns a tuple (announce, summary): whether
+        the build should be announced and, if a summary is due, the
+        summary's template variables.
+        """
+        if statusmessage in BUILD_STATES:
+            state = BUILD_STATES[statusmessage]
+        elif isinstance(statusmessage, basestring):
+            state = statusmessage.lower()
+        else:
+            # No status, like a pending build
+            state = None
+        entry = self._branches.pop(branch, None)
+        if entry is None:
+            entry = [None, 0]
+        self._branches[branch] = entry
+        if len(self._branches) > self.max_branches:
+            self._branches.popitem(last=False)
+        if state is None or state == entry[0]:
+            entry[1] += 1
+            if self.summary_after and entry[1] >= self.summary_after:
+                summary = {"branch": branch, "count": entry[1],
+                           "state": entry[0] or u"pending"}
+                entry[1] = 0
+                return (False, summary)
+            return (False, None)
+        entry[:] = [state, 0]
+        return (True, None)
+
+    def get_state(self):
+        return [[branch, state, count] for (branch, (state, count))
+                in self._branches.iteritems()]
+
+    def set_state(self, state):
+        self._branches.clear()
+        for (branch, branch_state, count) in state[-self.max_branches:]:
+            self._branches[branch] = [branch_state, count]
+
 
 class TravisCIWebhookListener(resource.Resource):
     """
     Resource waiting for a Travis CI push notification.
     """
 
-    def __init__(self, project, observer, message_format, travis_token):
+    def __init__(self, project, observer, message_format, travis_token,
+                 history=None, commit_filter=None, build_states=None):
         resource.Resource.__init__(self)
         self.project = project
         self.observer = observer
         self.message_format = message_format
         self.travis_token = travis_token
+        self.history = history
+        self.commit_filter = commit_filter
+        self.build_states = build_states
 
     def render_POST(self, request):
-        if "payload" not in request.args:
+        payload = get_payload(request)
+        if payload is None:
             request.setResponseCode(http.BAD_REQUEST)
             return ""
 
@@ -144,17 +254,41 @@ class TravisCIWebhookListener(resource.Resource):
             return ""
 
         try:
-            payload = json.loads(request.args["payload"][0])
-            buildinfo = self._extract_buildinfo(payload)
+            buildinfo = self._extract_buildinfo(json.loads(payload))
         except (KeyError, ValueError):
             request.setResponseCode(http.BAD_REQUEST)
             return ""
 
-        message = self.message_format.safe_substitute(project=self.project,
-                                                      **buildinfo)
-        self.observer.notify(self.project, message)
+        if self.commit_filter is None:
+            channels = None
+        elif self.commit_filter.accepts(buildinfo):
+            channels = self.commit_filter.channels_for(buildinfo)
+        else:
+            return ""
+
+        announce = True
+        if self.build_states is not None:
+            (announce, summary) = self.build_states.update(
+                buildinfo["branch"], buildinfo["statusmessage"])
+            if summary is not None:
+                self._notify(SUMMARY_MESSAGE.safe_substitute(
+                    project=self.project, **summary), channels)
+        if announce:
+            message = self.message_format.safe_substitute(
+                project=self.project, **buildinfo)
+            self._notify(message, channels)
+        if self.history is not None:
+            self.history.record(dict(buildinfo, shortmessage=u"%s: %s" % (
+                buildinfo["statusmessage"], buildinfo["shortmessage"])),
+                announced=announce)
         return ""
 
+    def _notify(self, message, channels):
+        if channels is None:
+            self.observer.notify(self.project, message)
+        else:
+            self.observer.notify(self.project, message, channels)
+
     def _check_authorization(self, hashed_token, repo_slug):
         if hashed_token is None or repo_slug is None:
             return False
@@ -191,34 +325,79 @@ class TravisCIWebhookListener(resource.Resource):
 
         return commit
 
+def create_filter(service, project, config, supported=FILTER_SETTINGS):
+    """Compiles the filter rules in a listener's `config`. Returns `None`
+    if there are none. Raises `ConfigurationError` if they are invalid or
+    use settings that are not in `supported`.
+    """
+    unsupported = (FILTER_SETTINGS - supported) & set(config)
+    if unsupported:
+        msg = "Project %r: Unsupported filter rules: %s"
+        raise ConfigurationError(
+            msg % (project, ", ".join(sorted(unsupported))))
+    channels = service.projects[project].channels
+    try:
+        return compile_filter(config, channels)
+    except (ValueError, KeyError, re.error), e:
+        msg = "Project %r: Invalid filter rules: %s"
+        raise ConfigurationError(msg % (project, e))
+
 class WebhookListenerFactory(object):
     def create(self, service, project, config, observer):
         message_format = string.Template(config["message"])
         resource = service.get_resource_for_project(project)
         child = WebhookListener(
             project, observer, message_format, self.commit_extractor,
-            config.get("max commit messages per push"))
+            config.get("max commit messages per push"),
+            service.get_history(project),
+            create_filter(service, project, config), self.paths_extractor)
         resource.putChild(self.name, child)
 
 class BitbucketListenerFactory(WebhookListenerFactory):
     name = u"bitbucket"
     commit_extractor = staticmethod(extract_bitbucket_commit)
+    paths_extractor = staticmethod(extract_bitbucket_paths)
 
 class GitHubListenerFactory(WebhookListenerFactory):
     name = u"github"
     commit_extractor = staticmethod(extract_github_commit)
+    paths_extractor = staticmethod(extract_github_paths)
 
 class TravisCIListenerFactory(object):
     name = u"travisci"
+    # Builds don't list the paths they touch
+    filter_settings = FILTER_SETTINGS - frozenset(["paths"])
 
     def create(self, service, project, config, observer):
         message_format = string.Template(config["message"])
         travis_token = config["token"]
         resource = service.get_resource_for_project(project)
+        commit_filter = create_filter(service, project, config,
+                                      self.filter_settings)
+        build_states = None
+        if config.get("only status changes"):
+            max_branches = config.get("max tracked branches", 1000)
+            summary_after = config.get("summary after")
+            if not _is_positive_int(max_branches):
+                msg = "Project %r: max tracked branches must be a " \
+                      "positive integer"
+                raise ConfigurationError(msg % (project, ))
+            if summary_after is not None and not _is_positive_int(
+                    summary_after):
+                msg = "Project %r: summary after must be a positive integer"
+                raise ConfigurationError(msg % (project, ))
+            build_states = BuildStates(max_branches, summary_after)
+            service.register_state(project, self.name, build_states)
         child = TravisCIWebhookListener(project, observer, message_format,
-                                        travis_token)
+                                        travis_token,
+                                        service.get_history(project),
+                                        commit_filter, build_states)
         resource.putChild(self.name, child)
 
+def _is_positive_int(value):
+    return (isinstance(value, (int, long)) and not isinstance(value, bool)
+            and value > 0)
+
 registry.register(BitbucketListenerFactory())
 registry.register(GitHubListenerFactory())
 registry.register(TravisCIListenerFactory())
@@ -1,27 +1,144 @@
 # encoding: utf-8
 
+import string
+
+from twisted.internet import defer
+from twisted.python import log
 from twisted.web import xmlrpc
 
+from trompet.errors import ConfigurationError
 from trompet.listeners import registry
+from trompet.listeners.filters import FILTER_SETTINGS
+from trompet.listeners.commits import announce_commits, complete_commit
+
+
+#: Message format for `notify_commits` if the project's configuration
+#: doesn't specify one.
+DEFAULT_MESSAGE = string.Template(
+    "$author committed rev $revision to $project/$branch: $shortmessage")
+
+
+def message_settings(project, config):
+    """Given a listener's configuration (either `True` or an object),
+    return a tuple (message format, max commits per push). Raises
+    `ConfigurationError` if it has filter rules, which aren't supported.
+    """
+    message_format = DEFAULT_MESSAGE
+    max_commits_per_push = None
+    if isinstance(config, dict):
+        filter_settings = FILTER_SETTINGS & set(config)
+        if filter_settings:
+            msg = "Project %r: Commits can't be filtered (%s)"
+            raise ConfigurationError(
+                msg % (project, ", ".join(sorted(filter_settings))))
+        if "message" in config:
+            message_format = string.Template(config["message"])
+        max_commits_per_push = config.get("max commit messages per push")
+    return (message_format, max_commits_per_push)
+
+
+class XMLRPCSystem(xmlrpc.XMLRPCIntrospection):
+    """
+    The ``system`` namespace: the introspection API plus
+    ``system.multicall``.
+    """
+
+    def xmlrpc_multicall(self, calls):
+        """
+        Call several methods with one request. Takes a list of structs
+        with the keys ``methodName`` and ``params`` and returns a list
+        with either the (single-item list wrapped) result or a fault
+        struct for each call.
+        """
+        results = []
+        for call in calls:
+            try:
+                name = call["methodName"]
+                params = call.get("params", [])
+                if name == "system.multicall":
+                    raise xmlrpc.Fault(self.FAILURE,
+                                       "Recursive multicall is forbidden")
+                procedure = self._xmlrpc_parent.lookupProcedure(name)
+                d = defer.maybeDeferred(procedure, *params)
+            except (KeyError, TypeError, AttributeError):
+                d = defer.fail(xmlrpc.Fault(self.FAILURE,
+                                            "Invalid call: %r" % (call, )))
+            except xmlrpc.Fault:
+                d = defer.fail()
+            d.addCallbacks(lambda result: [result], self._fault_struct)
+            results.append(d)
+        return defer.gatherResults(results)
+
+    def _fault_struct(self, failure):
+        if failure.check(xmlrpc.Fault):
+            fault = failure.value
+        else:
+            log.err(failure)
+            fault = xmlrpc.Fault(self.FAILURE, "error")
+        return {"faultCode": fault.faultCode, "faultString": fault.faultString}
 
 
 class XMLRPCInterface(xmlrpc.XMLRPC):
-    def __init__(self, project, observer, *args, **kwargs):
+    def __init__(self, project, observer, message_format=DEFAULT_MESSAGE,
+                 max_commits_per_push=None, history=None, *args, **kwargs):
         xmlrpc.XMLRPC.__init__(self, *args, **kwargs)
         self.project = project
         self.observer = observer
+        self.message_format = message_format
+        self.max_commits_per_push = max_commits_per_push
+        self.history = history
+        self.putSubHandler("system", XMLRPCSystem(self))
 
     def xmlrpc_notify(self, message):
         self.observer.notify(self.project, message)
+        if self.history is not None:
+            self.history.record({"message": message})
         return True
 
+    def xmlrpc_notify_commits(self, commits):
+        """
+        Announce a list of commits, formatted with the project's message
+        format. A commit is a struct with the same keys as the commit
+        objects of the webhook listeners (``shortmessage`` is derived
+        from ``message`` if missing). Returns a list with one item per
+        commit: `True` if it was announced, `False` if it was omitted
+        (see ``max commit messages per push``) or a fault struct if the
+        commit was invalid.
+        """
+        if not isinstance(commits, list):
+            raise xmlrpc.Fault(self.FAILURE, "Expected a list of commits")
+        results = []
+        valid_commits = []
+        for commit in commits:
+            if isinstance(commit, dict):
+                valid_commits.append(complete_commit(commit))
+                results.append(True)
+            else:
+                results.append({"faultCode": self.FAILURE,
+                                "faultString": "Commit must be a struct"})
+        omitted_commits = announce_commits(
+            self.observer, self.project, self.message_format, valid_commits,
+            self.max_commits_per_push, self.history)
+        # The omitted commits are the last valid ones
+        for i in reversed(xrange(len(results))):
+            if not omitted_commits:
+                break
+            if results[i] is True:
+                results[i] = False
+                omitted_commits -= 1
+        return results
+
 class ListenerFactory(object):
     name = u"xmlrpc"
 
     def create(self, service, project, config, observer):
         if config:
+            (message_format, max_commits_per_push) = message_settings(
+                project, config)
             resource = service.get_resource_for_project(project)
-            resource.putChild("xmlrpc", XMLRPCInterface(project, observer))
+            resource.putChild("xmlrpc", XMLRPCInterface(
+                project, observer, message_format, max_commits_per_push,
+                service.get_history(project)))
 
 listener_factory = ListenerFactory()
 registry.register(listener_factory)
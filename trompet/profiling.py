@@ -0,0 +1,146 @@
+# encoding: utf-8
+
+"""
+    Tools for finding out where the reactor spends its time in a running
+    trompet:
+
+    - `SamplingProfiler` samples the stack of the reactor thread from a
+      separate thread for a limited time and returns the result as
+      collapsed stacks (one line per stack, frames separated by ``;``,
+      followed by the number of samples), the input format of
+      FlameGraph's ``flamegraph.pl``.
+    - `StallWatchdog` logs the stack of the reactor thread whenever a
+      callback blocks it for longer than a threshold.
+
+    Both only run a thread while they are active, so they cost nothing
+    otherwise.
+"""
+
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import defaultdict
+
+from twisted.internet import defer, reactor, task
+from twisted.python import log
+
+
+#: Maximum duration of a profile in seconds.
+MAX_DURATION = 300
+
+
+def frame_stack(frame):
+    "Returns the collapsed stack of `frame`, outermost frame first."
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append("%s:%s" % (os.path.basename(code.co_filename),
+                                 code.co_name))
+        frame = frame.f_back
+    frames.reverse()
+    return ";".join(frames)
+
+
+class ProfilerBusy(Exception):
+    "Raised when a profile is requested while another one is running."
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stack of the reactor thread every `interval` seconds.
+    Only one profile can run at a time.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.running = False
+
+    def profile(self, duration):
+        """Profiles the reactor thread for `duration` seconds. Must be
+        called from the reactor thread. Returns a Deferred that fires with
+        the collapsed stacks, most frequent first.
+        """
+        if self.running:
+            return defer.fail(ProfilerBusy())
+        self.running = True
+        d = defer.Deferred()
+        thread = threading.Thread(
+            target=self._sample,
+            args=(threading.current_thread().ident,
+                  min(duration, MAX_DURATION), d),
+            name="trompet profiler")
+        thread.daemon = True
+        thread.start()
+        return d
+
+    def _sample(self, thread_id, duration, d):
+        counts = defaultdict(int)
+        deadline = time.time() + duration
+        while time.time() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                counts[frame_stack(frame)] += 1
+            # Don't keep a reference to the frame while sleeping
+            frame = None
+            time.sleep(self.interval)
+        lines = ["%s %i\n" % (stack, count) for (stack, count)
+                 in sorted(counts.iteritems(), key=lambda item: -item[1])]
+        reactor.callFromThread(self._finished, d, "".join(lines))
+
+    def _finished(self, d, result):
+        self.running = False
+        d.callback(result)
+
+
+class StallWatchdog(object):
+    """
+    Logs the stack of the reactor thread when it didn't run its event
+    loop for more than `threshold` seconds, i.e. when a callback blocks
+    it. A stall is logged once, no matter how long it lasts.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self._last_beat = None
+        self._heartbeat = None
+        self._stopped = None
+
+    def start(self):
+        "Starts watching. Must be called from the reactor thread."
+        self._last_beat = time.time()
+        self._heartbeat = task.LoopingCall(self._beat)
+        self._heartbeat.start(self.threshold / 4.0)
+        self._stopped = threading.Event()
+        thread = threading.Thread(
+            target=self._watch,
+            args=(threading.current_thread().ident, self._stopped),
+            name="trompet stall watchdog")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self._heartbeat is not None:
+            self._heartbeat.stop()
+            self._heartbeat = None
+            self._stopped.set()
+
+    def _beat(self):
+        self._last_beat = time.time()
+
+    def _watch(self, thread_id, stopped):
+        reported_beat = None
+        while not stopped.wait(self.threshold / 4.0):
+            last_beat = self._last_beat
+            stalled = time.time() - last_beat
+            if stalled > self.threshold and last_beat != reported_beat:
+                reported_beat = last_beat
+                frame = sys._current_frames().get(thread_id)
+                if frame is None:
+                    continue
+                stack = "".join(traceback.format_stack(frame))
+                frame = None
+                # Logged from this thread, as the reactor thread is busy
+                log.msg("Reactor stalled for %.3f seconds in:\n%s" %
+                        (stalled, stack))
@@ -4,23 +4,42 @@ try:
     import json
 except ImportError:
     import simplejson as json
+import os
 import random
 import re
 import signal
 import sys
+import tempfile
+import time
+from collections import Counter, defaultdict, deque
+from hashlib import sha1
 
 from twisted import plugin
 from twisted.application import internet, service
-from twisted.python import usage
+from twisted.internet import task
+from twisted.python import log, usage
 from twisted.web import resource
 from zope.interface import implements
 
 from trompet import irc, listeners
+from trompet.digest import ChannelDigest
+from trompet.errors import ConfigurationError
+from trompet.history import EventHistory
+from trompet.profiling import ProfilerBusy, SamplingProfiler, StallWatchdog
+from trompet.shards import ShardedProjects
+from trompet.unix import create_unix_service
 from trompet.web import create_web_service, reconfigure_web_service
 
 
-class ConfigurationError(Exception):
-    "Raised when there is an error in the configuration."
+#: Maximum number of messages per network that are kept while the bot
+#: is not connected.
+MAX_QUEUED_MESSAGES = 1000
+
+#: Queued messages are sent in batches of `FLUSH_BATCH_SIZE` messages
+#: every `FLUSH_INTERVAL` seconds, so that the server doesn't disconnect
+#: the bot for flooding.
+FLUSH_BATCH_SIZE = 5
+FLUSH_INTERVAL = 2
 
 
 class Project(object):
@@ -35,6 +54,22 @@ class Project(object):
         return "<Project(name=%r, token=%r)>" % (self.name, self.token)
 
 
+def _check_state(state):
+    """Raises `TypeError` if `state` doesn't have the structure written by
+    `Trompet.save_state`.
+    """
+    if not isinstance(state, dict):
+        raise TypeError("state is not an object")
+    for messages in state["messages"].itervalues():
+        for message in messages:
+            if (not isinstance(message, list) or len(message) != 2 or
+                not all(isinstance(part, basestring) for part in message)):
+                raise TypeError("invalid message %r" % (message, ))
+    for states in [state["objects"], state.get("digests", {})]:
+        if not all(isinstance(value, dict) for value in states.itervalues()):
+            raise TypeError("invalid saved states")
+
+
 class Trompet(service.MultiService):
     """
     The notify service itself.
@@ -47,7 +82,40 @@ class Trompet(service.MultiService):
         self._maker = maker
         self._irc = {}
         self.projects = {}
+        # Maps tokens to projects
+        self.tokens = {}
+        self.capture = None
+        self.unix = None
+        self.shards = None
+        self.histories = {}
+        self._history_size = 0
+        self._history_directory = None
+        # Names of the configured networks
+        self.networks = set()
+        # Messages that couldn't be sent yet, by network
+        self._queued = {}
+        # Scheduled calls sending the next batch of queued messages
+        self._flushes = {}
+        # Runtime controls and counters (see `trompet.web.AdminResource`)
+        self.paused_projects = set()
+        self.paused_networks = set()
+        self.project_counters = defaultdict(Counter)
+        self.network_counters = defaultdict(Counter)
+        # Maps (network, channel) to (settings, digest, looping call)
+        self._digests = {}
+        self._saved_digests = {}
+        # Clock for the digests and the queue, the reactor by default
+        self.clock = None
+        # Objects registered with `register_state` and the saved states of
+        # objects that don't exist (yet), by project and name
+        self._state_objects = {}
+        self._saved_state = {}
+        self.state_file = None
+        self.profiler = SamplingProfiler()
+        self.profiling_config = {}
+        self._watchdog = None
         self._previous_sighup_handler = None
+        self._previous_sigusr2_handler = None
 
     def add_project(self, project_name, config):
         self._check_project_config(project_name, config)
@@ -58,6 +126,7 @@ class Trompet(service.MultiService):
         self.web.putChild(token, child)
         project = Project(project_name, token, config["channels"], child)
         self.projects[project_name] = project
+        self.tokens[token] = project
         # Configure listeners
         for (name, value) in config.iteritems():
             if name in ["channels", "token"]:
@@ -70,6 +139,41 @@ class Trompet(service.MultiService):
             project.listeners.append(name)
             listener_factory.create(self, project_name, value, self)
 
+    def remove_project(self, project_name):
+        "Removes a project and its listeners."
+        project = self.projects.pop(project_name)
+        for (name, obj) in self._state_objects.pop(project_name, {}).items():
+            self._saved_state.setdefault(project_name, {})[name] = \
+                obj.get_state()
+        del self.tokens[project.token]
+        self.web.delEntity(project.token)
+        if self.unix is not None:
+            self.unix.listeners.pop(project.token, None)
+
+    def project_for_token(self, token):
+        """Returns the project with the given token, loading it from the
+        shards if necessary, or `None` if there is none.
+        """
+        if self.shards is not None and token in self.shards:
+            return self.shards.load(token)
+        return self.tokens.get(token)
+
+    def is_configured(self, project_name):
+        "Returns whether a project exists, even if it isn't loaded."
+        if project_name in self.projects:
+            return True
+        return self.shards is not None and project_name in self.shards.names
+
+    def configure_shards(self, config):
+        """(Re)configure the sharded projects (see `trompet.shards`).
+        Projects loaded from the previous index must have been removed.
+        """
+        self.shards = None
+        if config:
+            self.shards = ShardedProjects(
+                self, config["directory"],
+                config.get("max loaded projects", 1000))
+
     def add_irc_bot(self, name, bot):
         self._irc[name] = bot
 
@@ -80,34 +184,334 @@ class Trompet(service.MultiService):
         "Given a project's name, return the corresponding web resource."
         return self.projects[project_name].resource
 
-    def notify(self, project_name, message):
+    def configure_history(self, config):
+        """(Re)configure the event histories. Histories of removed projects
+        are dropped, so are all if the settings changed.
+        """
+        config = config or {}
+        size = config.get("events per project", 100)
+        directory = config.get("directory")
+        if (size, directory) != (self._history_size, self._history_directory):
+            for history in self.histories.values():
+                history.close()
+            self.histories.clear()
+            (self._history_size, self._history_directory) = (size, directory)
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def prune_histories(self):
+        "Drop the histories of projects that no longer exist."
+        for project_name in list(self.histories):
+            if not self.is_configured(project_name):
+                self.histories.pop(project_name).close()
+
+    def get_history(self, project_name):
+        """Return the event history of a project, or `None` if histories
+        are disabled.
+        """
+        history = self.histories.get(project_name)
+        if history is None and self._history_size:
+            path = None
+            if self._history_directory is not None:
+                # Project names can contain anything, so hash them
+                name = sha1(project_name.encode("utf-8")).hexdigest()
+                path = os.path.join(self._history_directory, name)
+            history = EventHistory(self._history_size, path)
+            self.histories[project_name] = history
+        return history
+
+    def register_state(self, project_name, name, obj):
+        """Registers an object of a project whose state is kept across
+        reloads and, if a state file is configured, restarts. `obj`
+        needs the methods `get_state` (returning something that can be
+        serialized to JSON) and `set_state`.
+        """
+        saved = self._saved_state.get(project_name, {}).pop(name, None)
+        if saved is not None:
+            try:
+                obj.set_state(saved)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                log.err(None, "Ignoring invalid saved state of %s of %r" %
+                        (name, project_name))
+        self._state_objects.setdefault(project_name, {})[name] = obj
+
+    def prune_states(self):
+        "Drop the saved states of projects that no longer exist."
+        for project_name in list(self._saved_state):
+            if not self.is_configured(project_name):
+                del self._saved_state[project_name]
+
+    def load_state(self, path):
+        """Loads the state saved by the previous process (queued messages
+        and the states of registered objects) from `path`. The file is
+        removed, so that it is only used once.
+        """
+        self.state_file = path
+        if path is None or not os.path.exists(path):
+            return
+        try:
+            with open(path) as state_file:
+                state = json.load(state_file)
+            _check_state(state)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            sys.stderr.write("Ignoring invalid state file %r\n" % (path, ))
+        else:
+            for (network, messages) in state["messages"].iteritems():
+                queue = self._queued.setdefault(
+                    network, deque(maxlen=MAX_QUEUED_MESSAGES))
+                queue.extend(tuple(message) for message in messages)
+            self._saved_state = state["objects"]
+            self._saved_digests = state.get("digests", {})
+        finally:
+            os.remove(path)
+
+    def save_state(self):
+        "Writes queued messages and registered states to the state file."
+        objects = dict((project_name, dict(states))
+                       for (project_name, states)
+                       in self._saved_state.iteritems())
+        for (project_name, objs) in self._state_objects.iteritems():
+            for (name, obj) in objs.iteritems():
+                objects.setdefault(project_name, {})[name] = obj.get_state()
+        state = {
+            "messages": dict((network, list(queue))
+                             for (network, queue) in self._queued.iteritems()
+                             if queue),
+            "objects": objects,
+            "digests": {},
+        }
+        for ((network, channel), (_, digest, _)) in self._digests.iteritems():
+            state["digests"].setdefault(network, {})[channel] = \
+                digest.get_state()
+        with open(self.state_file + ".tmp", "w") as state_file:
+            json.dump(state, state_file)
+        os.rename(self.state_file + ".tmp", self.state_file)
+
+    def configure_digests(self, networks):
+        """(Re)configure the channels in digest mode (see
+        `trompet.digest`) from the network configurations. Digests whose
+        settings changed are sent and started over. Raises
+        `ConfigurationError` (before changing anything) if a priority
+        pattern is invalid.
+        """
+        configs = {}
+        for (network, config) in networks.iteritems():
+            for (channel, settings) in (config.get("digests") or {}).items():
+                configs[(network, channel)] = settings
+        new_digests = {}
+        for ((network, channel), settings) in configs.iteritems():
+            current = self._digests.get((network, channel))
+            if current is not None and current[0] == settings:
+                continue
+            try:
+                new_digests[(network, channel)] = ChannelDigest(
+                    settings.get("interval", 300),
+                    settings.get("latest messages", 3),
+                    settings.get("max projects", 5),
+                    settings.get("priority"))
+            except re.error, e:
+                msg = "Digest of %s on %r: Invalid priority pattern: %s"
+                raise ConfigurationError(msg % (channel, network, e))
+        for (key, (settings, digest, call)) in self._digests.items():
+            if configs.get(key) != settings:
+                call.stop()
+                self._send_digest(*key)
+                del self._digests[key]
+        clock = self._get_clock()
+        for (key, digest) in new_digests.iteritems():
+            (network, channel) = key
+            saved = self._saved_digests.get(network, {}).pop(channel, None)
+            if saved is not None:
+                try:
+                    digest.set_state(saved)
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    log.err(None, "Ignoring invalid saved digest of %s" %
+                            (channel, ))
+            call = task.LoopingCall(self._send_digest, network, channel)
+            call.clock = clock
+            self._digests[key] = (configs[key], digest, call)
+            call.start(digest.interval, now=False)
+
+    def _get_clock(self):
+        if self.clock is None:
+            from twisted.internet import reactor
+            self.clock = reactor
+        return self.clock
+
+    def _send_digest(self, network, channel):
+        message = self._digests[(network, channel)][1].flush()
+        if message is not None:
+            self._send(network, channel, message)
+
+    def configure_profiling(self, config):
+        """(Re)configure the profiling settings and the stall watchdog
+        (see `trompet.profiling`).
+        """
+        self.profiling_config = config or {}
+        if self.running:
+            self._start_watchdog()
+
+    def _start_watchdog(self):
+        if self._watchdog is not None:
+            self._watchdog.stop()
+            self._watchdog = None
+        threshold = self.profiling_config.get("stall threshold")
+        if threshold:
+            self._watchdog = StallWatchdog(threshold)
+            self._watchdog.start()
+
+    def notify(self, project_name, message, channels=None):
         """Inform all IRC channels that are associated with a project
-        that something happened.
+        that something happened. `channels` (a dict mapping networks to
+        lists of channels) restricts the message to some of them.
+        Messages to networks that are not connected or paused are queued,
+        messages of paused projects are dropped and messages to channels
+        in digest mode are collected.
         """
         project = self.projects[project_name]
-        for (network, channels) in project.channels.iteritems():
-            bot = self._irc[network]
-            for channel in channels:
-                bot.msg(channel, message)
+        counters = self.project_counters[project_name]
+        if project_name in self.paused_projects:
+            counters["dropped"] += 1
+            return
+        counters["messages"] += 1
+        if channels is None:
+            channels = project.channels
+        for (network, network_channels) in channels.iteritems():
+            for channel in network_channels:
+                digest = self._digests.get((network, channel))
+                if digest is not None and digest[1].add(project_name, message):
+                    continue
+                self._send(network, channel, message)
+
+    def _send(self, network, channel, message):
+        if (self.is_connected(network) and
+            network not in self.paused_networks and
+            not self._queued.get(network)):
+            self._irc[network].msg(channel, message)
+            self.network_counters[network]["sent"] += 1
+        else:
+            # Behind the queued messages, if there are any
+            self._queue_message(network, channel, message)
+            self.flush_queue(network)
+
+    def flush_queue(self, network):
+        """Starts sending the queued messages of a network, unless it is
+        paused or not connected. The first batch is sent immediately, the
+        others every `FLUSH_INTERVAL` seconds. A message is only removed
+        from the queue once it was handed to the bot. Called on sign on.
+        """
+        pending = self._flushes.pop(network, None)
+        if pending is not None and pending.active():
+            # Already flushing
+            self._flushes[network] = pending
+            return
+        queue = self._queued.get(network)
+        for _ in xrange(FLUSH_BATCH_SIZE):
+            if (not queue or not self.is_connected(network) or
+                network in self.paused_networks):
+                return
+            (channel, message) = queue[0]
+            self._irc[network].msg(channel, message)
+            queue.popleft()
+            self.network_counters[network]["sent"] += 1
+        if queue:
+            self._flushes[network] = self._get_clock().callLater(
+                FLUSH_INTERVAL, self.flush_queue, network)
+
+    def drop_queue(self, network):
+        "Drops the queued messages of a network. Returns their number."
+        queue = self._queued.get(network)
+        if not queue:
+            return 0
+        dropped = len(queue)
+        queue.clear()
+        self.network_counters[network]["dropped"] += dropped
+        return dropped
+
+    def queue_length(self, network):
+        return len(self._queued.get(network, ()))
+
+    def is_connected(self, network):
+        bot = self._irc.get(network)
+        return bot is not None and bot.signed_on
+
+    def reconnect(self, network):
+        "Drops the connection to a network, so that the bot reconnects."
+        bot = self._irc[network]
+        bot.factory.resetDelay()
+        if bot.transport is not None:
+            bot.transport.loseConnection()
+
+    def _queue_message(self, network, channel, message):
+        queue = self._queued.get(network)
+        if queue is None:
+            queue = self._queued[network] = deque(maxlen=MAX_QUEUED_MESSAGES)
+        if len(queue) == queue.maxlen:
+            # The oldest message is pushed out
+            self.network_counters[network]["dropped"] += 1
+        queue.append((channel, message))
 
     def startService(self):
         service.MultiService.startService(self)
         if hasattr(signal, "SIGHUP"):
             self._previous_sighup_handler = signal.signal(
                 signal.SIGHUP, self._handle_sighup)
+        if hasattr(signal, "SIGUSR2"):
+            self._previous_sigusr2_handler = signal.signal(
+                signal.SIGUSR2, self._handle_sigusr2)
+        self._start_watchdog()
 
     def stopService(self):
+        for ((network, channel), (_, _, call)) in self._digests.iteritems():
+            call.stop()
+            if self.state_file is None:
+                # Can't be saved, so send it while the bots are connected
+                self._send_digest(network, channel)
+        for pending in self._flushes.itervalues():
+            if pending.active():
+                pending.cancel()
+        self._flushes.clear()
+        if self.state_file is not None:
+            self.save_state()
+        self._digests.clear()
         service.MultiService.stopService(self)
+        if self._watchdog is not None:
+            self._watchdog.stop()
+            self._watchdog = None
         if self._previous_sighup_handler is not None:
             signal.signal(signal.SIGHUP, self._previous_sighup_handler)
+        if self._previous_sigusr2_handler is not None:
+            signal.signal(signal.SIGUSR2, self._previous_sigusr2_handler)
+
+    def _handle_sigusr2(self, ignored_signum, ignored_frame):
+        config = self.profiling_config
+        directory = config.get("directory", tempfile.gettempdir())
+        path = os.path.join(directory, "trompet-profile-%i-%i.txt" %
+                            (os.getpid(), time.time()))
+        d = self.profiler.profile(config.get("seconds", 10))
+
+        def write(stacks):
+            with open(path, "w") as profile_file:
+                profile_file.write(stacks)
+            log.msg("Wrote profile to %s" % (path, ))
+
+        def busy(failure):
+            failure.trap(ProfilerBusy)
+            log.msg("Not profiling, a profile is already running")
+
+        d.addCallbacks(write, busy)
+        d.addErrback(log.err, "Could not write profile")
 
     def _handle_sighup(self, ignored_signum, ignored_frame):
         # Clean up all projects
-        for project in self.projects.values():
-            self.web.delEntity(project.token)
-        self.projects.clear()
+        if self.shards is not None:
+            self.shards.unload_all()
+        for project_name in list(self.projects):
+            self.remove_project(project_name)
         # …then reconfigure (will add the projects again)
         self._maker.reconfigure(self, self._maker.parse_config())
+        self.prune_histories()
+        self.prune_states()
 
     def _check_project_config(self, project_name, config):
         if "token" not in config:
@@ -142,7 +546,9 @@ class TrompetMaker(object):
         config = self.parse_config()
 
         trompet = Trompet(self)
+        trompet.load_state(config.get("state file"))
         create_web_service(trompet, config)
+        create_unix_service(trompet, config)
         self.reconfigure(trompet, config)
         return trompet
 
@@ -156,9 +562,12 @@ class TrompetMaker(object):
 
     def reconfigure(self, trompet, config):
         reconfigure_web_service(trompet, config)
+        trompet.configure_history(config.get("history"))
+        trompet.configure_profiling(config.get("profiling"))
 
         networks = config["networks"]
-        for (project_name, project) in config["projects"].iteritems():
+        trompet.networks = set(networks)
+        for (project_name, project) in config.get("projects", {}).iteritems():
             try:
                 trompet.add_project(project_name, project)
             except ConfigurationError, e:
@@ -167,6 +576,22 @@ class TrompetMaker(object):
             for (network, channels) in project["channels"].iteritems():
                 networks[network]["channels"].update(channels)
 
+        trompet.configure_shards(config.get("shards"))
+        if trompet.shards is not None:
+            for (token, entry) in trompet.shards.index.iteritems():
+                if (token in trompet.tokens or
+                    entry["project"] in trompet.projects):
+                    msg = "Sharded project %r: token or name already used\n"
+                    sys.stderr.write(msg % (entry["project"], ))
+                    sys.exit(1)
+                for (network, channels) in entry["channels"].iteritems():
+                    networks[network]["channels"].update(channels)
+
+        try:
+            trompet.configure_digests(networks)
+        except ConfigurationError, e:
+            sys.stderr.write(e.args[0] + "\n")
+            sys.exit(1)
         for (name, network) in networks.iteritems():
             try:
                 ircbot = trompet.get_irc_bot(name)
@@ -175,7 +600,8 @@ class TrompetMaker(object):
                 factory = irc.IRCFactory(trompet, name, network["nick"],
                                          network["channels"],
                                          network.get("nickserv-password", None),
-                                         network.get("password", None))
+                                         network.get("password", None),
+                                         network.get("line-separator", None))
                 irc_service = internet.TCPClient(host, port, factory)
                 irc_service.setName("irc-" + name)
                 irc_service.setServiceParent(trompet)
@@ -183,4 +609,5 @@ class TrompetMaker(object):
                 ircbot.factory.reconfigure(
                     ircbot, network["nick"], network["channels"],
                     network.get("nickserv-password", None),
-                    network.get("password", None))
+                    network.get("password", None),
+                    network.get("line-separator", None))
@@ -0,0 +1,147 @@
+# encoding: utf-8
+
+"""
+    Sharded project configuration for installations with many projects.
+
+    Instead of listing every project in the configuration file, projects
+    can be kept in a directory with one JSON file per project (the
+    project's configuration, plus its ``name``) and an index file,
+    ``index.json``, that maps every token to the project's name, file and
+    channels. At startup and on reload only the index is read; a project
+    is loaded the first time a request for its token arrives, and the
+    least recently used projects are unloaded again once more than
+    ``max loaded projects`` are loaded.
+
+    The index is (re)built with::
+
+        python -m trompet.shards <directory>
+"""
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import os
+import sys
+from collections import OrderedDict
+
+from twisted.python import log
+
+from trompet.errors import ConfigurationError
+
+
+INDEX_NAME = "index.json"
+
+
+class ShardedProjects(object):
+    """
+    Loads the projects of a shard directory on demand and keeps at most
+    `max_loaded` of them loaded (`None`: no limit).
+    """
+
+    def __init__(self, trompet, directory, max_loaded=1000):
+        self._trompet = trompet
+        self.directory = directory
+        self.max_loaded = max_loaded
+        with open(os.path.join(directory, INDEX_NAME)) as index_file:
+            # Maps tokens to {"project": ..., "file": ..., "channels": ...}
+            self.index = json.load(index_file)
+        self.names = frozenset(entry["project"]
+                               for entry in self.index.itervalues())
+        # Tokens of the loaded projects, least recently used first
+        self._loaded = OrderedDict()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, token):
+        return token in self.index
+
+    def is_loaded(self, token):
+        return token in self._loaded
+
+    def load(self, token):
+        """Returns the project for `token`, loading it if necessary.
+        Returns `None` if the token is unknown or the project can't be
+        loaded.
+        """
+        if token in self._loaded:
+            # Mark as most recently used
+            del self._loaded[token]
+            self._loaded[token] = True
+            return self._trompet.tokens[token]
+        entry = self.index.get(token)
+        if entry is None:
+            return None
+        try:
+            with open(os.path.join(self.directory, entry["file"])) as f:
+                config = json.load(f)
+            if config.get("token") != token:
+                raise ConfigurationError("token doesn't match the index")
+            config.pop("name", None)
+            self._trompet.add_project(entry["project"], config)
+        except (EnvironmentError, ValueError, ConfigurationError):
+            log.err(None, "Could not load project %r" % (entry["project"], ))
+            # Don't leave a half-configured project behind
+            if token in self._trompet.tokens:
+                self._trompet.remove_project(entry["project"])
+            return None
+        self._loaded[token] = True
+        if self.max_loaded is not None:
+            while len(self._loaded) > self.max_loaded:
+                (evicted, _) = self._loaded.popitem(last=False)
+                self._trompet.remove_project(
+                    self._trompet.tokens[evicted].name)
+        return self._trompet.tokens[token]
+
+    def unload_all(self):
+        for token in self._loaded:
+            self._trompet.remove_project(self._trompet.tokens[token].name)
+        self._loaded.clear()
+
+
+def build_index(directory):
+    """Reads all project files in `directory` and returns the index.
+    Raises `ValueError` if a token is used more than once.
+    """
+    index = {}
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".json") or name == INDEX_NAME:
+            continue
+        with open(os.path.join(directory, name)) as project_file:
+            config = json.load(project_file)
+        token = config["token"]
+        if token in index:
+            raise ValueError("Token of %s already used by %s" %
+                             (name, index[token]["file"]))
+        index[token] = {
+            "project": config.get("name", name[:-len(".json")]),
+            "file": name,
+            "channels": config["channels"],
+        }
+    return index
+
+def write_index(directory, index):
+    "Atomically replaces the index of `directory`."
+    path = os.path.join(directory, INDEX_NAME)
+    with open(path + ".tmp", "w") as index_file:
+        json.dump(index, index_file, indent=1, sort_keys=True)
+    os.rename(path + ".tmp", path)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) != 1:
+        sys.stderr.write("Usage: python -m trompet.shards <directory>\n")
+        sys.exit(2)
+    try:
+        index = build_index(argv[0])
+    except (EnvironmentError, ValueError, KeyError), e:
+        sys.stderr.write("Could not build index: %s\n" % (e, ))
+        sys.exit(1)
+    write_index(argv[0], index)
+    print "Indexed %i projects" % (len(index), )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import json
+import unittest
+
+try:
+    from unittest.mock import Mock, call
+except ImportError:
+    from mock import Mock, call
+
+from twisted.web.test.requesthelper import DummyRequest
+
+from trompet.service import Trompet
+from trompet.web import AdminResource, create_web_service
+
+
+class AdminResourceTest(unittest.TestCase):
+    def setUp(self):
+        self.trompet = Trompet(None)
+        create_web_service(self.trompet, {"web": {"port": 0}})
+        self.trompet.networks = set(["net"])
+        self.trompet.add_project(u"project", {
+            "token": "token", "channels": {"net": ["#channel"]}})
+        self.bot = Mock(signed_on=True)
+        self.trompet.add_irc_bot("net", self.bot)
+        self.resource = AdminResource(self.trompet)
+
+    def _request(self, method, *path):
+        request = DummyRequest(list(path))
+        request.method = method
+        if method == "GET":
+            body = self.resource.render_GET(request)
+        else:
+            body = self.resource.render_POST(request)
+        return (request.responseCode, json.loads(body))
+
+    def test_pause_project(self):
+        self._request("POST", "projects", "project", "pause")
+        self.trompet.notify(u"project", u"dropped")
+        self._request("POST", "projects", "project", "resume")
+        self.trompet.notify(u"project", u"sent")
+        self.assertEqual(self.bot.mock_calls, [call.msg("#channel", u"sent")])
+        (code, status) = self._request("GET")
+        self.assertEqual(status["projects"], {
+            u"project": {"messages": 1, "dropped": 1, "paused": False}})
+
+    def test_pause_network(self):
+        self._request("POST", "networks", "net", "pause")
+        self.trompet.notify(u"project", u"queued")
+        (code, status) = self._request("GET")
+        self.assertEqual(status["networks"]["net"], {
+            "paused": True, "connected": True, "queued": 1})
+        self.assertEqual(self.bot.mock_calls, [])
+        self.assertEqual(self._request("POST", "networks", "net", "drain"),
+                         (409, {"error": "paused"}))
+        self._request("POST", "networks", "net", "resume")
+        self.assertEqual(self.bot.mock_calls,
+                         [call.msg("#channel", u"queued")])
+
+    def test_drain_and_drop(self):
+        self.bot.signed_on = False
+        self.trompet.notify(u"project", u"first")
+        self.trompet.notify(u"project", u"second")
+        self.assertEqual(self._request("POST", "networks", "net", "drop"),
+                         (None, {"ok": True, "dropped": 2}))
+        self.trompet.notify(u"project", u"third")
+        self.bot.signed_on = True
+        self.assertEqual(self._request("POST", "networks", "net", "drain"),
+                         (None, {"ok": True, "queued": 1}))
+        self.assertEqual(self.bot.mock_calls, [call.msg("#channel", u"third")])
+        self.assertEqual(self.trompet.network_counters["net"],
+                         {"sent": 1, "dropped": 2})
+
+    def test_reconnect(self):
+        self._request("POST", "networks", "net", "reconnect")
+        self.assertEqual(self.bot.mock_calls, [
+            call.factory.resetDelay(), call.transport.loseConnection()])
+
+    def test_unknown(self):
+        self.assertEqual(self._request("POST", "networks", "other", "drop")[0],
+                         404)
+        self.assertEqual(self._request("POST", "projects", "project", "drop"),
+                         (404, {"error": "unknown action"}))
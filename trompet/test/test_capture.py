@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from twisted.web.test.requesthelper import DummyRequest
+
+from trompet.capture import CaptureWriter, capture_files, read_captures
+from trompet.service import Project
+
+
+class CaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.project = Project(u"project", "secret_token", {}, None)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _request(self, body):
+        request = DummyRequest(["secret_token", "travisci"])
+        request.method = "POST"
+        request.content = StringIO(body)
+        request.requestHeaders.addRawHeader("Authorization", "secret")
+        request.requestHeaders.addRawHeader("X-Hub-Signature-256", "secret")
+        request.requestHeaders.addRawHeader("X-Gitlab-Token", "secret")
+        request.requestHeaders.addRawHeader("Travis-Repo-Slug", "a/b")
+        return request
+
+    def test_capture_and_read(self):
+        writer = CaptureWriter(self.directory)
+        writer.capture(self.project, self._request("payload=%7B%7D"))
+        writer.close()
+        (record, ) = list(read_captures(capture_files(self.directory)))
+        self.assertEqual(record["project"], u"project")
+        self.assertEqual(record["path"], u"travisci")
+        self.assertEqual(record["body"], "payload=%7B%7D")
+        self.assertEqual(record["headers"], [[u"Travis-Repo-Slug", u"a/b"]])
+        with open(capture_files(self.directory)[0], "rb") as capture_file:
+            self.assertFalse("secret" in capture_file.read())
+
+    def test_rotation(self):
+        writer = CaptureWriter(self.directory, max_file_size=1, max_files=2)
+        for i in range(4):
+            writer.capture(self.project, self._request(str(i)))
+            # Capture files are named after the time they were started
+            os.rename(writer._file.name, os.path.join(
+                self.directory, "capture-%i.jsonl.gz" % (i, )))
+        writer.close()
+        paths = capture_files(self.directory)
+        self.assertEqual(len(paths), 2)
+        bodies = [record["body"] for record in read_captures(paths)]
+        self.assertEqual(bodies, ["2", "3"])
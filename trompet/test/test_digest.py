@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest.mock import Mock, call
+except ImportError:
+    from mock import Mock, call
+
+from twisted.internet import task
+
+from trompet.digest import ChannelDigest
+from trompet.errors import ConfigurationError
+from trompet.service import Trompet
+from trompet.web import create_web_service
+
+
+class ChannelDigestTest(unittest.TestCase):
+    def test_flush(self):
+        digest = ChannelDigest(interval=60, latest=2, max_projects=1)
+        self.assertEqual(digest.flush(), None)
+        for (project, message) in [(u"a", u"1"), (u"b", u"2\nbody"),
+                                   (u"b", u"3")]:
+            self.assertTrue(digest.add(project, message))
+        self.assertEqual(digest.flush(),
+                         u"Digest: 3 messages in 1 min (b: 2, 1 more projects)"
+                         u"\n[b] 2\n[b] 3")
+        self.assertEqual(len(digest), 0)
+        self.assertEqual(digest.flush(), None)
+
+    def test_priority(self):
+        digest = ChannelDigest(priority=[u"(?i)broken"])
+        self.assertFalse(digest.add(u"a", u"Build BROKEN"))
+        self.assertTrue(digest.add(u"a", u"Build passed"))
+        self.assertEqual(len(digest), 1)
+
+    def test_state(self):
+        digest = ChannelDigest(interval=30)
+        digest.add(u"a", u"1")
+        restored = ChannelDigest(interval=30)
+        restored.set_state(digest.get_state())
+        self.assertEqual(restored.flush(), digest.flush())
+
+
+class DigestModeTest(unittest.TestCase):
+    def test_digest_channel(self):
+        trompet = Trompet(None)
+        trompet.clock = task.Clock()
+        create_web_service(trompet, {"web": {"port": 0}})
+        for name in [u"a", u"b"]:
+            trompet.add_project(name, {
+                "token": name, "channels": {"net": ["#all", "#" + name]}})
+        trompet.configure_digests({"net": {"digests": {"#all": {
+            "interval": 10, "latest messages": 1, "priority": ["!"]}}}})
+        bot = Mock(signed_on=True)
+        trompet.add_irc_bot("net", bot)
+        trompet.notify(u"a", u"first")
+        trompet.notify(u"b", u"second")
+        trompet.notify(u"b", u"urgent!")
+        trompet.clock.advance(10)
+        self.assertEqual(bot.mock_calls, [
+            call.msg("#a", u"first"),
+            call.msg("#b", u"second"),
+            call.msg("#all", u"urgent!"),
+            call.msg("#b", u"urgent!"),
+            call.msg("#all", u"Digest: 2 messages in 10 s (a: 1, b: 1)\n"
+                             u"[b] second")])
+
+        # Changed settings send the pending digest
+        trompet.notify(u"a", u"third")
+        trompet.configure_digests({"net": {}})
+        trompet.notify(u"a", u"fourth")
+        self.assertEqual(bot.mock_calls[5:], [
+            call.msg("#a", u"third"),
+            call.msg("#all", u"Digest: 1 messages in 10 s (a: 1)\n"
+                             u"[a] third"),
+            call.msg("#all", u"fourth"),
+            call.msg("#a", u"fourth")])
+
+    def _create_trompet(self):
+        trompet = Trompet(None)
+        trompet.clock = task.Clock()
+        create_web_service(trompet, {"web": {"port": 0}})
+        trompet.add_project(u"a", {"token": "a",
+                                   "channels": {"net": ["#all"]}})
+        trompet.configure_digests({"net": {"digests": {"#all": {}}}})
+        return trompet
+
+    def test_pending_digest_is_sent_on_stop(self):
+        trompet = self._create_trompet()
+        bot = Mock(signed_on=True)
+        trompet.add_irc_bot("net", bot)
+        trompet.notify(u"a", u"first")
+        trompet.stopService()
+        self.assertEqual(bot.mock_calls, [
+            call.msg("#all", u"Digest: 1 messages in 5 min (a: 1)\n"
+                             u"[a] first")])
+        self.assertEqual(trompet.clock.getDelayedCalls(), [])
+
+    def test_pending_digest_is_saved_on_stop(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "state.json")
+        trompet = self._create_trompet()
+        trompet.load_state(path)
+        trompet.notify(u"a", u"first")
+        trompet.stopService()
+        self.assertEqual(trompet.clock.getDelayedCalls(), [])
+        self.assertEqual(trompet.queue_length("net"), 0)
+
+        trompet = Trompet(None)
+        trompet.load_state(path)
+        trompet.clock = task.Clock()
+        trompet.configure_digests({"net": {"digests": {"#all": {}}}})
+        self.assertEqual(trompet._digests[("net", "#all")][1].flush(),
+                         u"Digest: 1 messages in 5 min (a: 1)\n[a] first")
+
+    def test_invalid_priority(self):
+        trompet = self._create_trompet()
+        self.assertRaises(ConfigurationError, trompet.configure_digests,
+                          {"net": {"digests": {"#all": {"priority": ["("]}}}})
+        # The current digest is kept
+        self.assertTrue(("net", "#all") in trompet._digests)
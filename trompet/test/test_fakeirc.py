@@ -0,0 +1,37 @@
+import unittest
+
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+
+from trompet.benchmarks.fakeirc import FakeIRCFactory
+
+
+class FakeIRCTest(unittest.TestCase):
+    def _connect(self, **kwargs):
+        self.clock = Clock()
+        self.factory = FakeIRCFactory("net", clock=self.clock, **kwargs)
+        protocol = self.factory.buildProtocol(None)
+        self.transport = StringTransport()
+        protocol.makeConnection(self.transport)
+        return protocol
+
+    def test_registration_and_join(self):
+        protocol = self._connect()
+        protocol.dataReceived("NICK trompet\r\nJOIN #a,#b\r\n")
+        self.assertEqual(self.factory.joined, set(["#a", "#b"]))
+        self.assertTrue(":trompet!" in self.transport.value())
+
+    def test_flood_delay(self):
+        protocol = self._connect(penalty=2, burst=4)
+        protocol.dataReceived("".join(
+            "PRIVMSG #a :%i\r\n" % (i, ) for i in range(3)))
+        self.assertEqual([m.text for m in self.factory.messages], ["0", "1"])
+        self.clock.advance(2)
+        self.assertEqual(self.factory.messages[-1].text, "2")
+        self.assertEqual(self.factory.messages[-1].arrival, 2)
+
+    def test_excess_flood(self):
+        protocol = self._connect(penalty=2, burst=0, max_queued=1)
+        protocol.dataReceived("PRIVMSG #a :0\r\nPRIVMSG #a :1\r\n")
+        self.assertEqual(self.factory.flood_kills, 1)
+        self.assertTrue(self.transport.disconnecting)
@@ -0,0 +1,105 @@
+import json
+import string
+import unittest
+
+try:
+    from unittest.mock import Mock, call
+except ImportError:
+    from mock import Mock, call
+
+from twisted.web.test.requesthelper import DummyRequest
+
+from trompet.errors import ConfigurationError
+from trompet.listeners.filters import CommitFilter, compile_filter
+from trompet.listeners.webhook import WebhookListener
+from trompet.service import Trompet
+from trompet.web import create_web_service
+
+
+CHANNELS = {"net": ["#all", "#releases"]}
+
+
+class CommitFilterTest(unittest.TestCase):
+    def test_no_rules(self):
+        self.assertEqual(compile_filter({"message": "$revision"}), None)
+        self.assertEqual(compile_filter(True), None)
+
+    def test_branches(self):
+        commit_filter = CommitFilter({"branches": ["master", "release/*"],
+                                      "ignore branches": ["release/old*"]})
+        accepts = lambda branch: commit_filter.accepts({"branch": branch})
+        self.assertTrue(accepts("master"))
+        self.assertTrue(accepts("release/1.0"))
+        self.assertFalse(accepts("release/old-1.0"))
+        self.assertFalse(accepts("feature"))
+        self.assertFalse(accepts("master2"))
+
+    def test_authors(self):
+        commit_filter = CommitFilter({"ignore authors": ["bot"]})
+        self.assertFalse(commit_filter.accepts({"author": "bot"}))
+        self.assertTrue(commit_filter.accepts({"author": "human"}))
+        commit_filter = CommitFilter({"authors": ["human"]})
+        self.assertFalse(commit_filter.accepts({"author": "bot"}))
+
+    def test_paths_are_only_computed_if_needed(self):
+        get_paths = Mock(return_value=["docs/index.rst"])
+        commit_filter = CommitFilter({"ignore authors": ["bot"]})
+        self.assertTrue(commit_filter.accepts({}, get_paths))
+        self.assertFalse(get_paths.called)
+        commit_filter = CommitFilter({"paths": ["src/*"]})
+        self.assertFalse(commit_filter.accepts({}, get_paths))
+        get_paths.return_value = ["src/trompet.py"]
+        self.assertTrue(commit_filter.accepts({}, get_paths))
+
+    def test_routes(self):
+        route = {"branches": ["release/*"], "channels": {"net": ["#releases"]}}
+        commit_filter = CommitFilter({"routes": [route]}, CHANNELS)
+        self.assertEqual(commit_filter.channels_for({"branch": "release/1"}),
+                         {"net": ["#releases"]})
+        self.assertEqual(commit_filter.channels_for({"branch": "master"}),
+                         None)
+
+    def test_route_to_unknown_channel(self):
+        route = {"branches": ["*"], "channels": {"net": ["#unknown"]}}
+        self.assertRaises(ValueError, CommitFilter, {"routes": [route]},
+                          CHANNELS)
+
+
+class FilteredWebhookListenerTest(unittest.TestCase):
+    def test_filter_and_route(self):
+        observer = Mock()
+        route = {"branches": ["release/*"], "channels": {"net": ["#releases"]}}
+        commit_filter = CommitFilter(
+            {"ignore authors": ["bot"], "routes": [route]}, CHANNELS)
+        listener = WebhookListener(
+            "project", observer, string.Template("$rev"),
+            lambda payload, commit: commit, 1, None, commit_filter)
+        commits = [{"rev": 0, "author": "bot", "branch": "master"},
+                   {"rev": 1, "author": "human", "branch": "release/1"},
+                   {"rev": 2, "author": "human", "branch": "master"}]
+        request = DummyRequest([b"/"])
+        request.method = "POST"
+        request.args["payload"] = [json.dumps({"commits": commits})]
+        listener.render_POST(request)
+        expected = [call.notify("project", "1", {"net": ["#releases"]}),
+                    call.notify("project", "[1 commits omitted.]")]
+        self.assertEqual(observer.mock_calls, expected)
+
+
+class UnsupportedFilterTest(unittest.TestCase):
+    def _add_project(self, name, config):
+        trompet = Trompet(None)
+        create_web_service(trompet, {"web": {"port": 0}})
+        trompet.add_project(u"project", {"token": "token",
+                                         "channels": CHANNELS, name: config})
+
+    def test_xmlrpc(self):
+        self.assertRaises(ConfigurationError, self._add_project, "xmlrpc",
+                          {"branches": ["master"]})
+        self._add_project("xmlrpc", {"message": "$revision"})
+
+    def test_travisci_paths(self):
+        config = {"message": "$status", "token": "secret"}
+        self._add_project("travisci", dict(config, branches=["master"]))
+        self.assertRaises(ConfigurationError, self._add_project, "travisci",
+                          dict(config, paths=["src/*"]))
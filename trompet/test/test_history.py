@@ -0,0 +1,110 @@
+# encoding: utf-8
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest.mock import Mock
+except ImportError:
+    from mock import Mock
+
+from twisted.web.test.requesthelper import DummyRequest
+
+from trompet.history import EventHistory
+from trompet.web import HistoryResource
+
+
+def commit(i, branch=u"master", author=u"Author"):
+    return {"revision": u"rev%i" % (i, ), "author": author, "branch": branch,
+            "message": u"Message %i\nbody" % (i, ),
+            "shortmessage": u"Message %i…" % (i, )}
+
+
+class EventHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_bounded(self):
+        history = EventHistory(3)
+        for i in range(10):
+            history.record(commit(i), now=i)
+        self.assertEqual(len(history), 3)
+        revisions = [event.revision for event in history.query()]
+        self.assertEqual(revisions, [u"rev9", u"rev8", u"rev7"])
+
+    def test_query(self):
+        history = EventHistory(10)
+        history.record(commit(0, branch=u"feature"), now=1)
+        history.record(commit(1, author=u"Bot"), now=2)
+        history.record(commit(2), announced=False, now=3)
+        self.assertEqual([e.revision for e in history.query(branch=u"master")],
+                         [u"rev2", u"rev1"])
+        self.assertEqual([e.revision for e in history.query(author=u"Bot")],
+                         [u"rev1"])
+        self.assertEqual([e.revision for e in history.query(since=2)],
+                         [u"rev2", u"rev1"])
+        self.assertEqual([e.revision for e in history.query(limit=1)],
+                         [u"rev2"])
+        self.assertFalse(history.query()[0].announced)
+
+    def test_fields_are_truncated_and_interned(self):
+        history = EventHistory(10)
+        history.record(dict(commit(0), shortmessage=u"ä" * 1000))
+        history.record(commit(1, author=u"".join([u"Auth", u"or"])))
+        (second, first) = history.query()
+        self.assertEqual(first.message, u"ä" * 128)
+        self.assertTrue(first.author is second.author)
+
+    def test_persistence(self):
+        path = os.path.join(self.directory, "history")
+        history = EventHistory(3, path)
+        for i in range(4):
+            history.record(commit(i), now=i + 1)
+        history.close()
+        history = EventHistory(3, path)
+        events = history.query()
+        self.assertEqual([e.revision for e in events],
+                         [u"rev3", u"rev2", u"rev1"])
+        self.assertEqual(events[0].message, u"Message 3…")
+        self.assertEqual(events[0].time, 4)
+        history.record(commit(4), now=5)
+        self.assertEqual(history.query()[0].revision, u"rev4")
+        # A different size discards the file
+        history.close()
+        self.assertEqual(EventHistory(5, path).query(), [])
+
+
+class HistoryResourceTest(unittest.TestCase):
+    def setUp(self):
+        self.history = EventHistory(10)
+        self.history.record(commit(0), now=1)
+        self.history.record(commit(1, branch=u"feature"), now=2)
+        trompet = Mock()
+        trompet.is_configured.side_effect = lambda name: name == u"project"
+        trompet.get_history.return_value = self.history
+        self.resource = HistoryResource(trompet)
+
+    def _get(self, path, **args):
+        request = DummyRequest(path)
+        for (name, value) in args.items():
+            request.args[name] = [value]
+        return (request, self.resource.render_GET(request))
+
+    def test_query(self):
+        (request, body) = self._get(["project"], branch="feature")
+        events = json.loads(body)["events"]
+        self.assertEqual([event["revision"] for event in events], [u"rev1"])
+
+    def test_unknown_project(self):
+        (request, body) = self._get(["unknown"])
+        self.assertEqual(request.responseCode, 404)
+
+    def test_invalid_filter(self):
+        (request, body) = self._get(["project"], since="yesterday")
+        self.assertEqual(request.responseCode, 400)
@@ -0,0 +1,88 @@
+# encoding: utf-8
+
+import unittest
+
+from twisted.test.proto_helpers import StringTransport
+
+from trompet.irc import IRCBot, pack_lines
+
+
+class PackLinesTest(unittest.TestCase):
+    def test_short_lines(self):
+        lines = list(pack_lines([u"foo", u"bar"], 10))
+        self.assertEqual(lines, [u"foo", u"bar"])
+
+    def test_drops_empty_lines(self):
+        lines = list(pack_lines([u"foo", u"", u"bar"], 10))
+        self.assertEqual(lines, [u"foo", u"bar"])
+
+    def test_split_by_bytes(self):
+        lines = list(pack_lines([u"äöü"], 4))
+        self.assertEqual(lines, [u"äö", u"ü"])
+
+    def test_split_never_inside_character(self):
+        lines = list(pack_lines([u"aäöü"], 4))
+        self.assertEqual(lines, [u"aä", u"öü"])
+        for line in lines:
+            self.assertTrue(len(line.encode("utf-8")) <= 4)
+
+    def test_split_at_whitespace(self):
+        lines = list(pack_lines([u"foo bar baz"], 9))
+        self.assertEqual(lines, [u"foo bar", u"baz"])
+
+    def test_pack_with_separator(self):
+        lines = list(pack_lines([u"a", u"b", u"c", u"d"], 7, u" | "))
+        self.assertEqual(lines, [u"a | b", u"c | d"])
+
+    def test_pack_long_line_with_separator(self):
+        lines = list(pack_lines([u"a", u"bbbbbbbb", u"c"], 5, u" | "))
+        self.assertEqual(lines, [u"a", u"bbbbb", u"bbb", u"c"])
+
+
+class FakeFactory(object):
+    nickname = "trompet"
+    password = None
+    line_separator = None
+
+
+class IRCBotTest(unittest.TestCase):
+    def _create_bot(self, line_separator=None):
+        factory = FakeFactory()
+        factory.line_separator = line_separator
+        bot = IRCBot()
+        bot.factory = factory
+        transport = StringTransport()
+        bot.makeConnection(transport)
+        transport.clear()
+        return (bot, transport)
+
+    def _sent_lines(self, transport):
+        return transport.value().splitlines()
+
+    def test_lines_fit_into_protocol_line(self):
+        (bot, transport) = self._create_bot()
+        bot.msg(u"#channel", u"ä" * 1000)
+        lines = self._sent_lines(transport)
+        self.assertTrue(len(lines) > 1)
+        prefix = ":trompet!" + "u" * 10 + "@" + "h" * 63 + " "
+        for line in lines:
+            self.assertTrue(line.startswith("PRIVMSG #channel :"))
+            self.assertTrue(len(prefix + line + "\r\n") <= 512)
+            line.decode("utf-8")
+
+    def test_budget_uses_known_hostmask(self):
+        (bot, transport) = self._create_bot()
+        guessed = bot.line_budget("PRIVMSG #channel :")
+        bot.irc_JOIN("trompet!bot@example.org", ["#channel"])
+        self.assertEqual(bot.userhost, "bot@example.org")
+        budget = bot.line_budget("PRIVMSG #channel :")
+        self.assertEqual(budget, guessed + 74 - len("bot@example.org"))
+        self.assertEqual(
+            len(":trompet!bot@example.org PRIVMSG #channel :\r\n") + budget,
+            512)
+
+    def test_message_with_separator(self):
+        (bot, transport) = self._create_bot(line_separator=u" | ")
+        bot.msg(u"#channel", u"first commit\nsecond commit")
+        self.assertEqual(self._sent_lines(transport),
+                         ["PRIVMSG #channel :first commit | second commit"])
@@ -0,0 +1,22 @@
+import shutil
+import tempfile
+import unittest
+
+from trompet.benchmarks.loadtest import expected_joins, generate_config
+
+
+class ExpectedJoinsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_channels_shared_by_networks(self):
+        # gcd(networks, channels) > 1: every network only gets some of
+        # the channels
+        options = {"projects": 8, "networks": 2, "channels": 4}
+        path = generate_config(self.directory, options, [6667, 6668])
+        self.assertEqual(expected_joins(path), {
+            u"net0": set([u"#bench-0", u"#bench-2"]),
+            u"net1": set([u"#bench-1", u"#bench-3"])})
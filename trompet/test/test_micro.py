@@ -0,0 +1,23 @@
+import unittest
+
+from trompet.benchmarks import micro
+
+
+class MicroBenchmarkTest(unittest.TestCase):
+    def test_benchmarks_run(self):
+        for (name, benchmark) in micro.BENCHMARKS.items():
+            benchmark(micro.FIXTURES["tiny"])()
+
+    def test_measure(self):
+        result = micro.measure(lambda: None, repeat=1, min_time=0.001)
+        self.assertTrue(result["seconds"] >= 0)
+
+    def test_compare(self):
+        baseline = {"a/tiny": {"seconds": 1.0, "peak_bytes": 100},
+                    "b/tiny": {"seconds": 1.0}}
+        results = {"a/tiny": {"seconds": 1.1, "peak_bytes": 200},
+                   "b/tiny": {"seconds": 1.5, "peak_bytes": 200},
+                   "c/tiny": {"seconds": 9.0}}
+        self.assertEqual(micro.compare(results, baseline, 0.2),
+                         [("a/tiny", "peak_bytes", 2.0),
+                          ("b/tiny", "seconds", 1.5)])
@@ -0,0 +1,112 @@
+import sys
+import time
+
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    from mock import Mock, patch
+
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from trompet.profiling import (MAX_DURATION, ProfilerBusy, SamplingProfiler,
+                               StallWatchdog, frame_stack)
+from trompet.web import ProfileResource
+
+
+def busy_loop(seconds):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        pass
+
+
+class SamplingProfilerTest(unittest.TestCase):
+    def test_frame_stack(self):
+        stack = frame_stack(sys._getframe())
+        self.assertTrue(stack.endswith(";test_profiling.py:test_frame_stack"))
+
+    def test_profile(self):
+        profiler = SamplingProfiler(interval=0.001)
+        d = profiler.profile(0.2)
+        reactor.callLater(0.01, busy_loop, 0.1)
+
+        def check(stacks):
+            self.assertFalse(profiler.running)
+            counts = dict(line.rsplit(" ", 1) for line in stacks.splitlines())
+            busy = [int(count) for (stack, count) in counts.items()
+                    if stack.endswith("test_profiling.py:busy_loop")]
+            self.assertEqual(len(busy), 1)
+            self.assertTrue(busy[0] > 1)
+
+        return d.addCallback(check)
+
+    def test_busy(self):
+        profiler = SamplingProfiler()
+        d = profiler.profile(0.01)
+        self.assertFailure(profiler.profile(0.01), ProfilerBusy)
+        return d
+
+
+class StallWatchdogTest(unittest.TestCase):
+    def test_stall_is_logged(self):
+        watchdog = StallWatchdog(0.05)
+        watchdog.start()
+        self.addCleanup(watchdog.stop)
+        patcher = patch("trompet.profiling.log")
+        log = patcher.start()
+        self.addCleanup(patcher.stop)
+        d = task.deferLater(reactor, 0.01, busy_loop, 0.3)
+        d.addCallback(lambda _: task.deferLater(reactor, 0.1, lambda: 0))
+
+        def check(_):
+            self.assertEqual(len(log.msg.mock_calls), 1)
+            self.assertTrue("in busy_loop" in log.msg.call_args[0][0])
+
+        return d.addCallback(check)
+
+
+class ProfileResourceTest(unittest.TestCase):
+    def setUp(self):
+        self.trompet = Mock(profiling_config={"seconds": 3})
+        self.trompet.profiler.profile.return_value = defer.succeed("a;b 1\n")
+        self.resource = ProfileResource(self.trompet)
+
+    def _get(self, seconds=None):
+        request = DummyRequest(["profile"])
+        if seconds is not None:
+            request.args["seconds"] = [seconds]
+        result = self.resource.render_GET(request)
+        if isinstance(result, str):
+            request.write(result)
+            request.finish()
+        return request
+
+    def test_default_duration_from_config(self):
+        request = self._get()
+        self.trompet.profiler.profile.assert_called_once_with(3.0)
+        self.assertEqual(request.written, ["a;b 1\n"])
+
+    def test_duration_is_limited(self):
+        self._get("1e9")
+        self.trompet.profiler.profile.assert_called_once_with(MAX_DURATION)
+
+    def test_invalid_duration(self):
+        for seconds in ["-1", "0", "nan", "ten"]:
+            self.assertEqual(self._get(seconds).responseCode, 400)
+        self.assertFalse(self.trompet.profiler.profile.called)
+
+    def test_busy(self):
+        self.trompet.profiler.profile.return_value = defer.fail(ProfilerBusy())
+        request = self._get()
+        self.assertEqual(request.responseCode, 409)
+        self.assertEqual(request.finished, 1)
+
+    def test_failure(self):
+        self.trompet.profiler.profile.return_value = defer.fail(
+            RuntimeError("broken"))
+        with patch("trompet.web.log") as log:
+            request = self._get()
+        self.assertTrue(log.err.called)
+        self.assertEqual(request.responseCode, 500)
+        self.assertEqual(request.finished, 1)
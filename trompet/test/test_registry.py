@@ -0,0 +1,90 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from trompet.listeners import _registry
+
+
+class FakeListenerFactory(object):
+    name = u"fake"
+
+    def create(self, service, project, config, observer):
+        return (service, project, config, observer)
+
+fake_listener_factory = FakeListenerFactory()
+
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tempdir, "listeners.json")
+        self.registry = _registry._ServiceRegistry(self.cache_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_unknown_listener(self):
+        self.registry._discovered = True
+        self.assertRaises(KeyError, self.registry.get, u"unknown")
+
+    def test_lazy_listener_is_loaded_on_create(self):
+        self.registry.register_lazy(
+            u"fake", __name__ + ":fake_listener_factory")
+        proxy = self.registry.get(u"fake")
+        self.assertTrue(isinstance(proxy, _registry._LazyListener))
+        self.assertEqual(proxy.create(1, 2, 3, 4), (1, 2, 3, 4))
+        self.assertTrue(self.registry.get(u"fake") is fake_listener_factory)
+
+    def test_register_replaces_lazy_listener(self):
+        self.registry.register_lazy(u"fake", "does.not.exist")
+        self.registry.register(fake_listener_factory)
+        self.assertTrue(self.registry.get(u"fake") is fake_listener_factory)
+        self.assertRaises(ValueError, self.registry.register,
+                          fake_listener_factory)
+
+    def test_discover_uses_cached_index(self):
+        cache = {
+            "fingerprint": _registry._sys_path_fingerprint(),
+            "listeners": {u"fake": __name__ + ":fake_listener_factory"}
+        }
+        with open(self.cache_path, "w") as cache_file:
+            json.dump(cache, cache_file)
+        self.assertTrue(
+            self.registry.get(u"fake").load() is fake_listener_factory)
+
+    def _scan(self):
+        return {u"fake": __name__ + ":fake_listener_factory"}
+
+    def test_discover_does_not_rescan_fresh_index(self):
+        with patch.object(_registry, "_scan_entry_points",
+                          side_effect=self._scan) as scan:
+            self.registry.discover()
+            _registry._ServiceRegistry(self.cache_path).discover()
+        self.assertEqual(scan.call_count, 1)
+        self.assertTrue(u"fake" in self.registry.services)
+
+    def test_discover_rebuilds_stale_index(self):
+        cache = {
+            "fingerprint": [["/does/not/exist", 0]],
+            "listeners": {u"stale": "stale.module"}
+        }
+        with open(self.cache_path, "w") as cache_file:
+            json.dump(cache, cache_file)
+        with patch.object(_registry, "_scan_entry_points",
+                          side_effect=self._scan) as scan:
+            self.registry.discover()
+        self.assertEqual(scan.call_count, 1)
+        self.assertTrue(u"fake" in self.registry.services)
+        self.assertFalse(u"stale" in self.registry.services)
+        with open(self.cache_path) as cache_file:
+            cache = json.load(cache_file)
+        self.assertEqual(cache["fingerprint"],
+                         _registry._sys_path_fingerprint())
+        self.assertEqual(cache["listeners"], self._scan())
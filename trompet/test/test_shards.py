@@ -0,0 +1,81 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from twisted.web.test.requesthelper import DummyRequest
+
+from trompet.service import Trompet
+from trompet.shards import ShardedProjects, build_index, write_index
+from trompet.web import create_web_service
+
+
+def write_project(directory, name, token):
+    config = {"name": name, "token": token,
+              "channels": {"net": ["#" + token]}, "xmlrpc": True}
+    with open(os.path.join(directory, token + ".json"), "w") as f:
+        json.dump(config, f)
+
+
+class ShardedProjectsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for i in range(5):
+            write_project(self.directory, u"project %i" % (i, ), "token%i" % i)
+        write_index(self.directory, build_index(self.directory))
+        self.trompet = Trompet(None)
+        create_web_service(self.trompet, {"web": {"port": 0}})
+        self.trompet.shards = ShardedProjects(self.trompet, self.directory, 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_index(self):
+        self.assertEqual(self.trompet.shards.index["token1"], {
+            "project": u"project 1", "file": u"token1.json",
+            "channels": {"net": ["#token1"]}})
+        self.assertEqual(self.trompet.projects, {})
+        self.assertTrue(self.trompet.is_configured(u"project 1"))
+        self.assertFalse(self.trompet.is_configured(u"project 5"))
+
+    def test_duplicate_token(self):
+        write_project(self.directory, u"copy", "token1")
+        os.rename(os.path.join(self.directory, "token1.json"),
+                  os.path.join(self.directory, "copy.json"))
+        write_project(self.directory, u"project 1", "token1")
+        self.assertRaises(ValueError, build_index, self.directory)
+
+    def test_loaded_on_request(self):
+        request = DummyRequest(["token1", "xmlrpc"])
+        child = self.trompet.web.getChildWithDefault("token1", request)
+        self.assertTrue(child is self.trompet.projects[u"project 1"].resource)
+        self.assertEqual(self.trompet.projects[u"project 1"].listeners,
+                         [u"xmlrpc"])
+        self.assertEqual(list(self.trompet.projects), [u"project 1"])
+
+    def test_unknown_token(self):
+        self.assertEqual(self.trompet.project_for_token("unknown"), None)
+        self.assertEqual(self.trompet.projects, {})
+
+    def test_least_recently_used_is_evicted(self):
+        for token in ["token0", "token1", "token0", "token2"]:
+            self.trompet.project_for_token(token)
+        self.assertEqual(sorted(self.trompet.tokens), ["token0", "token2"])
+        self.assertFalse("token1" in self.trompet.web.children)
+        # Loaded again on demand
+        self.assertEqual(self.trompet.project_for_token("token1").name,
+                         u"project 1")
+
+    def test_broken_project_file(self):
+        with open(os.path.join(self.directory, "token3.json"), "w") as f:
+            f.write("{")
+        with mock.patch("trompet.shards.log") as log:
+            self.assertEqual(self.trompet.project_for_token("token3"), None)
+        self.assertTrue(log.err.called)
+        self.assertEqual(self.trompet.projects, {})
@@ -0,0 +1,150 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest.mock import Mock, call, patch
+except ImportError:
+    from mock import Mock, call, patch
+
+from twisted.internet import task
+
+from trompet.listeners.webhook import BuildStates
+from trompet.service import FLUSH_BATCH_SIZE, FLUSH_INTERVAL, Trompet
+from trompet.web import create_web_service, inherited_socket
+
+
+def create_trompet():
+    trompet = Trompet(None)
+    create_web_service(trompet, {"web": {"port": 0}})
+    trompet.add_project(u"project", {"token": "token",
+                                     "channels": {"net": ["#channel"]}})
+    return trompet
+
+
+class StateHandoffTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "state.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_messages_are_queued_until_signed_on(self):
+        trompet = create_trompet()
+        trompet.notify(u"project", u"first")
+        bot = Mock(signed_on=False)
+        trompet.add_irc_bot("net", bot)
+        trompet.notify(u"project", u"second")
+        self.assertEqual(bot.mock_calls, [])
+        bot.signed_on = True
+        trompet.flush_queue("net")
+        trompet.notify(u"project", u"third")
+        self.assertEqual(bot.mock_calls, [call.msg("#channel", u"first"),
+                                          call.msg("#channel", u"second"),
+                                          call.msg("#channel", u"third")])
+
+    def test_queue_is_sent_in_batches(self):
+        trompet = create_trompet()
+        trompet.clock = task.Clock()
+        for i in range(FLUSH_BATCH_SIZE * 2 + 1):
+            trompet.notify(u"project", u"message %i" % (i, ))
+        bot = Mock(signed_on=True)
+        trompet.add_irc_bot("net", bot)
+        trompet.flush_queue("net")
+        self.assertEqual(len(bot.msg.mock_calls), FLUSH_BATCH_SIZE)
+        # New messages are sent after the queued ones
+        trompet.notify(u"project", u"new")
+        self.assertEqual(len(bot.msg.mock_calls), FLUSH_BATCH_SIZE)
+        trompet.clock.advance(FLUSH_INTERVAL)
+        self.assertEqual(len(bot.msg.mock_calls), FLUSH_BATCH_SIZE * 2)
+        # Messages stay queued while the bot is disconnected
+        bot.signed_on = False
+        trompet.clock.advance(FLUSH_INTERVAL)
+        self.assertEqual(trompet.queue_length("net"), 2)
+        bot.signed_on = True
+        trompet.flush_queue("net")
+        self.assertEqual(trompet.queue_length("net"), 0)
+        self.assertEqual(bot.msg.mock_calls[-2:],
+                         [call("#channel", u"message 10"),
+                          call("#channel", u"new")])
+        self.assertEqual(trompet.clock.getDelayedCalls(), [])
+
+    def test_handoff(self):
+        trompet = create_trompet()
+        trompet.load_state(self.path)
+        build_states = BuildStates()
+        build_states.update(u"master", u"Passed")
+        trompet.register_state(u"project", u"travisci", build_states)
+        trompet.notify(u"project", u"queued")
+        trompet.save_state()
+
+        trompet = create_trompet()
+        trompet.load_state(self.path)
+        self.assertFalse(os.path.exists(self.path))
+        build_states = BuildStates()
+        trompet.register_state(u"project", u"travisci", build_states)
+        self.assertEqual(build_states.update(u"master", u"Fixed"),
+                         (False, None))
+        bot = Mock(signed_on=True)
+        trompet.add_irc_bot("net", bot)
+        trompet.flush_queue("net")
+        self.assertEqual(bot.mock_calls, [call.msg("#channel", u"queued")])
+
+    def test_state_survives_removal(self):
+        trompet = create_trompet()
+        build_states = BuildStates()
+        build_states.update(u"master", u"Passed")
+        trompet.register_state(u"project", u"travisci", build_states)
+        trompet.remove_project(u"project")
+        build_states = BuildStates()
+        trompet.register_state(u"project", u"travisci", build_states)
+        self.assertEqual(len(build_states), 1)
+
+    def test_invalid_state_file(self):
+        with open(self.path, "w") as state_file:
+            state_file.write("{")
+        with patch("sys.stderr"):
+            Trompet(None).load_state(self.path)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_wrong_shape_state_file(self):
+        for state in [[], {"objects": {}}, {"messages": [], "objects": {}},
+                      {"messages": {"net": [["#channel"]]}, "objects": {}},
+                      {"messages": {}, "objects": {u"project": []}}]:
+            with open(self.path, "w") as state_file:
+                json.dump(state, state_file)
+            trompet = Trompet(None)
+            with patch("sys.stderr") as stderr:
+                trompet.load_state(self.path)
+            self.assertTrue(stderr.write.called)
+            self.assertFalse(os.path.exists(self.path))
+            self.assertEqual(trompet.queue_length("net"), 0)
+
+    def test_invalid_saved_object_state(self):
+        trompet = create_trompet()
+        trompet._saved_state = {u"project": {u"travisci": [u"master"]}}
+        build_states = BuildStates()
+        with patch("trompet.service.log") as log:
+            trompet.register_state(u"project", u"travisci", build_states)
+        self.assertTrue(log.err.called)
+        self.assertEqual(len(build_states), 0)
+
+
+class InheritedSocketTest(unittest.TestCase):
+    def test_not_activated(self):
+        with patch.dict(os.environ, clear=True):
+            self.assertEqual(inherited_socket(), None)
+
+    def test_other_process(self):
+        environ = {"LISTEN_PID": str(os.getpid() + 1), "LISTEN_FDS": "1"}
+        with patch.dict(os.environ, environ, clear=True):
+            self.assertEqual(inherited_socket(), None)
+
+    def test_activated(self):
+        environ = {"LISTEN_PID": str(os.getpid()), "LISTEN_FDS": "1"}
+        with patch.dict(os.environ, environ, clear=True):
+            self.assertEqual(inherited_socket(), 3)
+            self.assertFalse("LISTEN_FDS" in os.environ)
@@ -0,0 +1,69 @@
+import json
+import unittest
+
+try:
+    from unittest.mock import Mock, call
+except ImportError:
+    from mock import Mock, call
+
+from twisted.test.proto_helpers import StringTransport
+
+from trompet.listeners.unix import UnixSocketListener
+from trompet.listeners.xmlrpc import DEFAULT_MESSAGE
+from trompet.unix import NotificationFactory
+
+
+class NotificationProtocolTest(unittest.TestCase):
+    def setUp(self):
+        self.observer = Mock()
+        factory = NotificationFactory()
+        factory.listeners["token"] = UnixSocketListener(
+            "project", self.observer, DEFAULT_MESSAGE, 1)
+        self.protocol = factory.buildProtocol(None)
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def _request(self, request):
+        self.transport.clear()
+        self.protocol.dataReceived(json.dumps(request) + "\n")
+        return json.loads(self.transport.value())
+
+    def test_message(self):
+        reply = self._request({"token": "token", "message": "Hello"})
+        self.assertEqual(reply, {"ok": True, "omitted": 0})
+        self.assertEqual(self.observer.mock_calls,
+                         [call.notify("project", "Hello")])
+
+    def test_commits(self):
+        commits = [{"author": "a", "revision": "1", "branch": "master",
+                    "message": "first"},
+                   {"message": "second"}]
+        reply = self._request({"token": "token", "commits": commits})
+        self.assertEqual(reply, {"ok": True, "omitted": 1})
+        self.assertEqual(self.observer.mock_calls, [
+            call.notify("project", "a committed rev 1 to project/master: "
+                                   "first"),
+            call.notify("project", "[1 commits omitted.]")])
+
+    def test_malformed_requests(self):
+        for request in [[], {"message": "Hello"}, {"token": ["token"]},
+                        {"token": "token", "message": 42},
+                        {"token": "token", "commits": {}},
+                        {"token": "token", "commits": [{"message": 42}]}]:
+            reply = self._request(request)
+            self.assertEqual(reply, {"ok": False,
+                                     "error": "malformed request"})
+        self.assertTrue(self.transport.connected)
+        self.assertEqual(self.observer.mock_calls, [])
+
+    def test_unknown_token(self):
+        reply = self._request({"token": "unknown", "message": "Hello"})
+        self.assertEqual(reply, {"ok": False, "error": "unknown token"})
+        self.assertEqual(self.observer.mock_calls, [])
+
+    def test_malformed_request(self):
+        self.protocol.dataReceived("not json\n")
+        reply = json.loads(self.transport.value())
+        self.assertEqual(reply, {"ok": False, "error": "malformed request"})
+        reply = self._request({"token": "token", "commits": ["invalid"]})
+        self.assertEqual(reply, {"ok": False, "error": "malformed request"})
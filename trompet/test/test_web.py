@@ -0,0 +1,113 @@
+import gzip
+import unittest
+import zlib
+from StringIO import StringIO
+
+from twisted.web import http, server
+from twisted.web.resource import Resource
+from twisted.web.test.requesthelper import DummyChannel, DummyRequest
+
+from trompet.service import Project
+from trompet.web import (DecodingRequest, ProjectsListing,
+                         create_projects_resource)
+
+
+class Recorder(Resource):
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.requests = []
+
+    def render_POST(self, request):
+        self.requests.append((request.args, request.content.read()))
+        return ""
+
+
+def gzip_compress(data):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb") as gzip_file:
+        gzip_file.write(data)
+    return buf.getvalue()
+
+
+class DecodingRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.recorder = Recorder()
+        self.channel = DummyChannel()
+        self.channel.site = server.Site(self.recorder)
+        self.channel.site.max_request_size = 1000
+
+    def _post(self, body, encoding=None, chunk_size=7,
+              content_type="application/x-www-form-urlencoded"):
+        request = DecodingRequest(self.channel)
+        request.requestHeaders.setRawHeaders("content-type", [content_type])
+        if encoding is not None:
+            request.requestHeaders.setRawHeaders("content-encoding",
+                                                 [encoding])
+        request.gotLength(len(body))
+        for i in range(0, len(body), chunk_size):
+            request.handleContentChunk(body[i:i + chunk_size])
+        request.requestReceived("POST", "/hook", "HTTP/1.1")
+        return request
+
+    def test_identity(self):
+        request = self._post("payload=%7B%7D")
+        self.assertEqual(request.code, http.OK)
+        self.assertEqual(self.recorder.requests[0][0], {"payload": ["{}"]})
+
+    def test_gzip(self):
+        self._post(gzip_compress("payload=%7B%7D"), "gzip")
+        self.assertEqual(self.recorder.requests[0][0], {"payload": ["{}"]})
+
+    def test_deflate(self):
+        for body in [zlib.compress("{}"), zlib.compress("{}")[2:-4]]:
+            self._post(body, "deflate", content_type="application/json")
+        self.assertEqual([content for (_, content) in self.recorder.requests],
+                         ["{}", "{}"])
+
+    def test_too_large(self):
+        request = self._post(gzip_compress("x" * 1001), "gzip")
+        self.assertEqual(request.code, http.REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(self.recorder.requests, [])
+
+    def test_exactly_max_size(self):
+        self._post(gzip_compress("x" * 1000), "gzip",
+                   content_type="text/plain")
+        self.assertEqual(len(self.recorder.requests[0][1]), 1000)
+
+    def test_invalid_body(self):
+        request = self._post("not compressed at all", "gzip")
+        self.assertEqual(request.code, http.BAD_REQUEST)
+
+    def test_unsupported_encoding(self):
+        request = self._post("data", "br")
+        self.assertEqual(request.code, http.UNSUPPORTED_MEDIA_TYPE)
+
+
+class FakeTrompet(object):
+    shards = None
+
+    def __init__(self):
+        self.projects = {}
+
+
+class ProjectsListingTest(unittest.TestCase):
+    def test_only_mounted_listeners_are_linked(self):
+        trompet = FakeTrompet()
+        project = Project(u"project", "token", {}, Resource())
+        project.listeners = [u"github", u"unix"]
+        project.resource.putChild("github", Resource())
+        trompet.projects[u"project"] = project
+        request = DummyRequest(["projects"])
+        request.prePathURL = lambda: "http://trompet.example.org/projects"
+        body = ProjectsListing(trompet).render_GET(request)
+        self.assertTrue("/token/github" in body)
+        self.assertFalse("/token/unix" in body)
+
+    def test_requires_password(self):
+        resource = create_projects_resource(
+            FakeTrompet(), {"web": {"password": "secret"}})
+        request = DummyRequest([])
+        resource.render(request)
+        self.assertEqual(request.responseCode, 401)
@@ -1,6 +1,8 @@
 import json
 import string
 import unittest
+from hashlib import sha256
+from StringIO import StringIO
 
 try:
     from unittest.mock import Mock, call
@@ -9,7 +11,11 @@ except ImportError:
 
 from twisted.web.test.requesthelper import DummyRequest
 
-from trompet.listeners.webhook import WebhookListener, extract_bitbucket_commit
+from trompet.errors import ConfigurationError
+from trompet.listeners.webhook import (BuildStates, TravisCIListenerFactory,
+                                       TravisCIWebhookListener,
+                                       WebhookListener,
+                                       extract_bitbucket_commit)
 
 
 class BitbucketTest(unittest.TestCase):
@@ -93,3 +99,103 @@ class WebHookListenerTest(unittest.TestCase):
         self.assertEqual(request.responseCode, None)
         expected = [call.notify('project', str(i)) for i in range(3)]
         self.assertEqual(observer.mock_calls, expected)
+
+    def test_json_body(self):
+        (observer, listener) = self._create_listener()
+        request = DummyRequest([b"/"])
+        request.method = "POST"
+        request.requestHeaders.setRawHeaders(
+            "Content-Type", ["application/json; charset=utf-8"])
+        request.content = StringIO(json.dumps({"commits": [{"rev": 1}]}))
+        listener.render_POST(request)
+        self.assertEqual(observer.mock_calls, [call.notify('project', '1')])
+
+    def test_history(self):
+        history = Mock()
+        listener = WebhookListener("project", Mock(), string.Template("$rev"),
+                                   self._commit_extractor, 1, history)
+        listener.render_POST(self._create_request(2))
+        expected = [call.record({"rev": 0}),
+                    call.record({"rev": 1}, announced=False)]
+        self.assertEqual(history.mock_calls, expected)
+
+
+class TravisCIWebhookListenerTest(unittest.TestCase):
+    def _create_listener(self, build_states=None):
+        observer = Mock()
+        listener = TravisCIWebhookListener(
+            "project", observer, string.Template("$branch: $statusmessage"),
+            "secret", build_states=build_states)
+        return (observer, listener)
+
+    def _build(self, listener, statusmessage, branch="master"):
+        payload = {"author_name": "a", "commit": "1", "message": "m",
+                   "compare_url": "url", "branch": branch,
+                   "status_message": statusmessage, "build_url": "build"}
+        request = DummyRequest([b"/"])
+        request.method = "POST"
+        request.args["payload"] = [json.dumps(payload)]
+        request.requestHeaders.setRawHeaders("Travis-Repo-Slug", ["a/b"])
+        request.requestHeaders.setRawHeaders(
+            "Authorization", [sha256("a/b" + "secret").hexdigest()])
+        listener.render_POST(request)
+
+    def test_every_build_by_default(self):
+        (observer, listener) = self._create_listener()
+        for status in ["Passed", "Passed"]:
+            self._build(listener, status)
+        self.assertEqual(observer.mock_calls,
+                         [call.notify("project", "master: Passed")] * 2)
+
+    def test_only_status_changes(self):
+        (observer, listener) = self._create_listener(BuildStates())
+        for (status, branch) in [("Passed", "master"), ("Passed", "master"),
+                                 ("Passed", "feature"), ("Broken", "master"),
+                                 ("Still Failing", "master"),
+                                 ("Fixed", "master")]:
+            self._build(listener, status, branch)
+        self.assertEqual(observer.mock_calls, [
+            call.notify("project", "master: Passed"),
+            call.notify("project", "feature: Passed"),
+            call.notify("project", "master: Broken"),
+            call.notify("project", "master: Fixed")])
+
+    def test_summary(self):
+        (observer, listener) = self._create_listener(BuildStates(
+            summary_after=2))
+        for _ in range(5):
+            self._build(listener, "Passed")
+        self.assertEqual(observer.mock_calls, [
+            call.notify("project", "master: Passed"),
+            call.notify("project", u"Travis CI: 2 more builds for "
+                                   u"project/master, still passing."),
+            call.notify("project", u"Travis CI: 2 more builds for "
+                                   u"project/master, still passing.")])
+
+
+class BuildStatesTest(unittest.TestCase):
+    def test_bounded(self):
+        states = BuildStates(max_branches=2)
+        for branch in ["a", "b", "a", "c"]:
+            states.update(branch, u"Passed")
+        self.assertEqual(len(states), 2)
+        self.assertEqual(states.update("a", u"Passed"), (False, None))
+        # "b" was forgotten, so its next build is announced again
+        self.assertEqual(states.update("b", u"Passed"), (True, None))
+
+    def test_missing_status(self):
+        states = BuildStates()
+        self.assertEqual(states.update("a", u"Passed"), (True, None))
+        self.assertEqual(states.update("a", None), (False, None))
+        self.assertEqual(states.update("a", u"Broken"), (True, None))
+
+    def test_invalid_settings(self):
+        service = Mock(projects={"project": Mock(channels={})})
+        config = {"message": "$statusmessage", "token": "secret",
+                  "only status changes": True}
+        for settings in [{"max tracked branches": None},
+                         {"max tracked branches": 0},
+                         {"summary after": "5"}]:
+            self.assertRaises(ConfigurationError,
+                              TravisCIListenerFactory().create, service,
+                              "project", dict(config, **settings), Mock())
@@ -0,0 +1,58 @@
+# encoding: utf-8
+
+import string
+import unittest
+
+try:
+    from unittest.mock import Mock, call
+except ImportError:
+    from mock import Mock, call
+
+from trompet.listeners.xmlrpc import XMLRPCInterface
+
+
+class XMLRPCInterfaceTest(unittest.TestCase):
+    def _create_interface(self, limit=None):
+        observer = Mock()
+        message_format = string.Template("$project: $revision $shortmessage")
+        interface = XMLRPCInterface("project", observer, message_format, limit)
+        return (observer, interface)
+
+    def _commits(self, number_of_commits):
+        return [{"revision": str(i), "message": "message %i\nbody" % (i, )}
+                for i in range(number_of_commits)]
+
+    def test_notify_commits(self):
+        (observer, interface) = self._create_interface()
+        results = interface.xmlrpc_notify_commits(self._commits(2))
+        self.assertEqual(results, [True, True])
+        expected = [call.notify("project", u"project: %i message %i…"
+                                % (i, i)) for i in range(2)]
+        self.assertEqual(observer.mock_calls, expected)
+
+    def test_notify_commits_omitted(self):
+        (observer, interface) = self._create_interface(limit=2)
+        commits = self._commits(2) + ["invalid"] + self._commits(2)
+        results = interface.xmlrpc_notify_commits(commits)
+        self.assertEqual(results[:2], [True, True])
+        self.assertEqual(results[2]["faultCode"], interface.FAILURE)
+        self.assertEqual(results[3:], [False, False])
+        self.assertEqual(observer.mock_calls[-1],
+                         call.notify("project", "[2 commits omitted.]"))
+
+    def test_multicall(self):
+        (observer, interface) = self._create_interface()
+        multicall = interface.lookupProcedure("system.multicall")
+        d = multicall([
+            {"methodName": "notify", "params": ["message"]},
+            {"methodName": "notify_commits", "params": [self._commits(1)]},
+            {"methodName": "does_not_exist", "params": []},
+            {"methodName": "system.multicall", "params": [[]]},
+        ])
+        results = []
+        d.addCallback(results.append)
+        (results, ) = results
+        self.assertEqual(results[:2], [[True], [[True]]])
+        self.assertEqual(results[2]["faultCode"], interface.NOT_FOUND)
+        self.assertEqual(results[3]["faultCode"], interface.FAILURE)
+        self.assertEqual(len(observer.mock_calls), 2)
@@ -0,0 +1,106 @@
+# encoding: utf-8
+
+"""
+    UNIX domain socket for notifications from git servers that run on
+    the same machine as trompet. Access is controlled by the socket's
+    file permissions.
+
+    Clients send one JSON object per line and get one JSON object per
+    line back, so that many notifications can share a connection. A
+    request contains the project's ``token`` and either a ``message``
+    or a list of ``commits``::
+
+        {"token": "my_secret_token", "message": "Hello"}
+        {"ok": true, "omitted": 0}
+"""
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from twisted.application import internet
+from twisted.internet import protocol
+from twisted.protocols import basic
+
+
+def is_valid_request(request):
+    """Returns whether `request` has the expected shape: a string
+    ``token`` and either a string ``message`` or a list of ``commits``
+    whose fields are strings.
+    """
+    if not isinstance(request, dict):
+        return False
+    if not isinstance(request.get("token"), basestring):
+        return False
+    if "message" in request:
+        return isinstance(request["message"], basestring)
+    commits = request.get("commits")
+    if not isinstance(commits, list):
+        return False
+    for commit in commits:
+        if not isinstance(commit, dict):
+            return False
+        if not all(isinstance(value, basestring) or value is None
+                   for value in commit.itervalues()):
+            return False
+    return True
+
+
+class NotificationProtocol(basic.LineOnlyReceiver):
+    delimiter = "\n"
+    MAX_LENGTH = 4 * 1024 * 1024
+
+    def lineReceived(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            request = None
+        if not is_valid_request(request):
+            self._reply(ok=False, error="malformed request")
+            return
+        listener = self.factory.get_listener(request["token"])
+        if listener is None:
+            self._reply(ok=False, error="unknown token")
+            return
+        try:
+            omitted_commits = listener.handle(request)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self._reply(ok=False, error="malformed request")
+        else:
+            self._reply(ok=True, omitted=omitted_commits)
+
+    def lineLengthExceeded(self, line):
+        self._reply(ok=False, error="request too long")
+        self.transport.loseConnection()
+
+    def _reply(self, **reply):
+        self.sendLine(json.dumps(reply))
+
+
+class NotificationFactory(protocol.ServerFactory):
+    protocol = NotificationProtocol
+
+    def __init__(self, trompet=None):
+        self._trompet = trompet
+        # Maps project tokens to listeners
+        self.listeners = {}
+
+    def get_listener(self, token):
+        "Returns the listener for `token`, or `None`."
+        if self._trompet is not None:
+            # Sharded projects are loaded on demand
+            self._trompet.project_for_token(token)
+        return self.listeners.get(token)
+
+
+def create_unix_service(trompet, config):
+    "Creates the UNIX socket service, if it is configured."
+    if "unix" not in config:
+        return
+    factory = NotificationFactory(trompet)
+    trompet.unix = factory
+    mode = int(config["unix"].get("mode", "660"), 8)
+    service = internet.UNIXServer(config["unix"]["path"], factory,
+                                  mode=mode, wantPID=True)
+    service.setServiceParent(trompet)
@@ -1,11 +1,24 @@
-from twisted.application import internet
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import os
+import socket
+import tempfile
+import zlib
+
+from twisted.application import internet, service
+from twisted.python import log
 from twisted.cred.portal import IRealm, Portal
 from twisted.cred.checkers import InMemoryUsernamePasswordDatabaseDontUse
-from twisted.web import server
+from twisted.web import http, server
 from twisted.web.guard import HTTPAuthSessionWrapper, DigestCredentialFactory
 from twisted.web.resource import IResource, Resource
 from zope.interface import implements
 
+from trompet.capture import CaptureWriter
+from trompet.profiling import MAX_DURATION, ProfilerBusy
+
 
 class Root(Resource):
     isLeaf = True
@@ -33,15 +46,35 @@ class Root(Resource):
         return self.HTML
 
 
-class ProjectsListingRealm(object):
+class ProjectsRoot(Resource):
+    """
+    The root resource. Projects are children named after their tokens;
+    sharded projects are loaded on their first request.
+    """
+
+    def __init__(self, trompet):
+        Resource.__init__(self)
+        self._trompet = trompet
+
+    def getChildWithDefault(self, path, request):
+        if self._trompet.shards is not None:
+            # Loads the project, or marks it as recently used
+            self._trompet.project_for_token(path)
+        return Resource.getChildWithDefault(self, path, request)
+
+
+class AdminRealm(object):
+    """
+    Realm that gives the admin access to a single resource.
+    """
     implements(IRealm)
 
-    def __init__(self, config):
-        self._config = config
+    def __init__(self, resource):
+        self._resource = resource
 
     def requestAvatar(self, avatarID, mind, *interfaces):
         if IResource in interfaces:
-            return (IResource, ProjectsListing(self._config), lambda: None)
+            return (IResource, self._resource, lambda: None)
         raise NotImplementedError()
 
 
@@ -64,6 +97,12 @@ class ProjectsListing(Resource):
         """]
         for project in self._trompet.projects.values():
             parts.append(self._render_project(request, project))
+        shards = self._trompet.shards
+        if shards is not None:
+            for (token, entry) in shards.index.iteritems():
+                if not shards.is_loaded(token):
+                    parts.append("<li>%s (not loaded)</li>" %
+                                 (entry["project"].encode("utf-8"), ))
         parts.append("</ul></body></html>")
         return "".join(parts)
 
@@ -72,29 +111,416 @@ class ProjectsListing(Resource):
         root_url = request.prePathURL()[:-len("/projects")]
         for name in project.listeners:
             name = str(name)
+            if name not in project.resource.children:
+                # Not reachable via HTTP (e.g. the UNIX socket listener)
+                continue
             url = "/".join([root_url, str(project.token), name])
             parts.append('<li><a href="%s">%s</a></li>' % (url, name))
         parts.append("</ul></li>")
         return "".join(parts)
 
 
-def create_projects_resource(trompet, config):
+class AdminResource(Resource):
+    """
+    JSON control API for a running trompet at ``/admin``:
+
+    - ``GET /admin``: Counters and states of all projects and networks.
+    - ``POST /admin/projects/<name>/<action>`` with the actions ``pause``
+      (drop its messages) and ``resume``.
+    - ``POST /admin/networks/<name>/<action>`` with the actions
+      ``pause`` (queue its messages), ``resume``, ``drain`` (start
+      sending the queued messages now), ``drop`` (drop them) and ``reconnect``.
+    """
+    isLeaf = True
+
+    def __init__(self, trompet):
+        Resource.__init__(self)
+        self._trompet = trompet
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "application/json")
+        if [part for part in request.postpath if part]:
+            request.setResponseCode(http.NOT_FOUND)
+            return json.dumps({"error": "not found"})
+        return json.dumps(self._status())
+
+    def render_POST(self, request):
+        request.setHeader("Content-Type", "application/json")
+        if len(request.postpath) != 3:
+            request.setResponseCode(http.NOT_FOUND)
+            return json.dumps({"error": "not found"})
+        (kind, name, action) = request.postpath
+        name = name.decode("utf-8", "replace")
+        if kind == "projects" and self._trompet.is_configured(name):
+            handler = getattr(self, "project_" + action, None)
+        elif kind == "networks" and name in self._trompet.networks:
+            handler = getattr(self, "network_" + action, None)
+        else:
+            request.setResponseCode(http.NOT_FOUND)
+            return json.dumps({"error": "unknown %s" % (kind, )})
+        if handler is None:
+            request.setResponseCode(http.NOT_FOUND)
+            return json.dumps({"error": "unknown action"})
+        try:
+            result = handler(name)
+        except ValueError, e:
+            request.setResponseCode(http.CONFLICT)
+            return json.dumps({"error": e.args[0]})
+        return json.dumps(dict(result or {}, ok=True))
+
+    def project_pause(self, name):
+        self._trompet.paused_projects.add(name)
+
+    def project_resume(self, name):
+        self._trompet.paused_projects.discard(name)
+
+    def network_pause(self, name):
+        self._trompet.paused_networks.add(name)
+
+    def network_resume(self, name):
+        self._trompet.paused_networks.discard(name)
+        if self._trompet.is_connected(name):
+            self._trompet.flush_queue(name)
+
+    def network_drain(self, name):
+        if not self._trompet.is_connected(name):
+            raise ValueError("not connected")
+        if name in self._trompet.paused_networks:
+            raise ValueError("paused")
+        queued = self._trompet.queue_length(name)
+        self._trompet.flush_queue(name)
+        return {"queued": queued}
+
+    def network_drop(self, name):
+        return {"dropped": self._trompet.drop_queue(name)}
+
+    def network_reconnect(self, name):
+        try:
+            self._trompet.reconnect(name)
+        except KeyError:
+            raise ValueError("not connected")
+
+    def _status(self):
+        trompet = self._trompet
+        projects = {}
+        for name in set(trompet.projects) | set(trompet.project_counters):
+            projects[name] = dict(trompet.project_counters.get(name, {}),
+                                  paused=name in trompet.paused_projects)
+        networks = {}
+        for name in trompet.networks:
+            networks[name] = dict(trompet.network_counters.get(name, {}),
+                                  paused=name in trompet.paused_networks,
+                                  connected=trompet.is_connected(name),
+                                  queued=trompet.queue_length(name))
+        return {"projects": projects, "networks": networks}
+
+
+#: Default maximum size of a decompressed request body in bytes.
+MAX_REQUEST_SIZE = 10 * 1024 * 1024
+
+
+class DecodingRequest(server.Request):
+    """
+    Request that decompresses gzip or deflate encoded bodies while they
+    are received, so that the listeners always see the plain body. Bodies
+    that decompress to more than the site's `max_request_size` bytes are
+    rejected.
+    """
+
+    _decoder = None
+    _decoding_error = None
+
+    def gotLength(self, length):
+        encoding = (self.requestHeaders.getRawHeaders("content-encoding") or
+                    ["identity"])[0].strip().lower()
+        if encoding in ["gzip", "x-gzip"]:
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            self._decoder = zlib.decompressobj()
+        elif encoding != "identity":
+            self._decoding_error = (http.UNSUPPORTED_MEDIA_TYPE,
+                                    "unsupported content encoding")
+        if self._decoder is None:
+            server.Request.gotLength(self, length)
+            return
+        self.requestHeaders.removeHeader("content-encoding")
+        self._remaining = self.channel.site.max_request_size
+        self._first_chunk = True
+        self.content = tempfile.TemporaryFile()
+
+    def handleContentChunk(self, data):
+        if self._decoding_error is not None:
+            return
+        if self._decoder is None:
+            server.Request.handleContentChunk(self, data)
+            return
+        try:
+            self._decode(data)
+        except zlib.error:
+            if not self._first_chunk:
+                self._decoding_error = (http.BAD_REQUEST, "invalid body")
+                return
+            # Some clients send raw deflate data without the zlib header
+            self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            try:
+                self._decode(data)
+            except zlib.error:
+                self._decoding_error = (http.BAD_REQUEST, "invalid body")
+        self._first_chunk = False
+
+    def _decode(self, data):
+        while data and self._decoding_error is None:
+            # Never decompress more than allowed, not even temporarily
+            decoded = self._decoder.decompress(data, self._remaining + 1)
+            if len(decoded) > self._remaining:
+                self._decoding_error = (http.REQUEST_ENTITY_TOO_LARGE,
+                                        "request body too large")
+                return
+            self.content.write(decoded)
+            self._remaining -= len(decoded)
+            data = self._decoder.unconsumed_tail
+
+    def requestReceived(self, command, path, version):
+        if self._decoder is not None and self._decoding_error is None:
+            try:
+                rest = self._decoder.flush(self._remaining + 1)
+            except zlib.error:
+                self._decoding_error = (http.BAD_REQUEST, "invalid body")
+            else:
+                if len(rest) > self._remaining:
+                    self._decoding_error = (http.REQUEST_ENTITY_TOO_LARGE,
+                                            "request body too large")
+                self.content.write(rest)
+        server.Request.requestReceived(self, command, path, version)
+
+    def process(self):
+        if self._decoding_error is None:
+            server.Request.process(self)
+            return
+        (code, message) = self._decoding_error
+        self.setResponseCode(code)
+        self.setHeader("Content-Type", "text/plain")
+        self.write(message + "\n")
+        self.finish()
+
+
+class CapturingSite(server.Site):
+    """
+    Site that records the requests to the projects' listeners if
+    capturing is enabled (see `trompet.capture`).
+    """
+
+    requestFactory = DecodingRequest
+    max_request_size = MAX_REQUEST_SIZE
+
+    def __init__(self, trompet, resource, *args, **kwargs):
+        server.Site.__init__(self, resource, *args, **kwargs)
+        self._trompet = trompet
+
+    def getResourceFor(self, request):
+        capture = self._trompet.capture
+        if capture is not None and request.postpath:
+            project = self._trompet.project_for_token(request.postpath[0])
+            if project is not None:
+                try:
+                    capture.capture(project, request)
+                except EnvironmentError:
+                    log.err(None, "Could not capture request")
+        return server.Site.getResourceFor(self, request)
+
+
+class HistoryResource(Resource):
+    """
+    JSON view of a project's event history at
+    ``/history/<project name>``. Takes the optional query arguments
+    ``branch``, ``author``, ``since`` (UNIX timestamp) and ``limit``.
+    """
+    isLeaf = True
+
+    def __init__(self, trompet):
+        Resource.__init__(self)
+        self._trompet = trompet
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "application/json")
+        project_name = "/".join(request.postpath).decode("utf-8", "replace")
+        if not self._trompet.is_configured(project_name):
+            request.setResponseCode(http.NOT_FOUND)
+            return json.dumps({"error": "unknown project"})
+        history = self._trompet.get_history(project_name)
+        if history is None:
+            request.setResponseCode(http.NOT_FOUND)
+            return json.dumps({"error": "history disabled"})
+        try:
+            filters = self._parse_filters(request)
+        except ValueError:
+            request.setResponseCode(http.BAD_REQUEST)
+            return json.dumps({"error": "invalid filter"})
+        events = [event.as_dict() for event in history.query(**filters)]
+        return json.dumps({"project": project_name, "events": events})
+
+    def _parse_filters(self, request):
+        filters = {}
+        for (name, convert) in [("branch", unicode), ("author", unicode),
+                                ("since", float), ("limit", int)]:
+            if name in request.args:
+                value = request.args[name][0]
+                if convert is unicode:
+                    filters[name] = value.decode("utf-8")
+                else:
+                    filters[name] = convert(value)
+        return filters
+
+
+class ProfileResource(Resource):
+    """
+    Profiles the reactor for ``seconds`` (query argument, by default the
+    ``seconds`` of the profiling settings, at most `MAX_DURATION`) and
+    returns the collapsed stacks (see `trompet.profiling`).
+    """
+    isLeaf = True
+
+    def __init__(self, trompet):
+        Resource.__init__(self)
+        self._trompet = trompet
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/plain")
+        default = self._trompet.profiling_config.get("seconds", 10)
+        try:
+            seconds = float(request.args.get("seconds", [default])[0])
+        except ValueError:
+            seconds = None
+        # Also rejects NaN
+        if not seconds > 0:
+            request.setResponseCode(http.BAD_REQUEST)
+            return "invalid duration\n"
+        disconnected = []
+        request.notifyFinish().addErrback(disconnected.append)
+        d = self._trompet.profiler.profile(min(seconds, MAX_DURATION))
+        d.addErrback(self._busy, request)
+        d.addCallback(self._write, request, disconnected)
+        d.addErrback(self._failed, request, disconnected)
+        return server.NOT_DONE_YET
+
+    def _busy(self, failure, request):
+        failure.trap(ProfilerBusy)
+        request.setResponseCode(http.CONFLICT)
+        return "a profile is already running\n"
+
+    def _write(self, body, request, disconnected):
+        if not disconnected:
+            request.write(body)
+            request.finish()
+
+    def _failed(self, failure, request, disconnected):
+        log.err(failure, "Profiling failed")
+        if not disconnected and not request.finished:
+            request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+            request.write("profiling failed\n")
+            request.finish()
+
+
+# Not exported by Python 2's socket module (value from Linux)
+SO_DOMAIN = getattr(socket, "SO_DOMAIN", 39)
+
+#: First file descriptor passed by systemd (SD_LISTEN_FDS_START).
+LISTEN_FDS_START = 3
+
+
+class AdoptedPortService(service.Service):
+    """
+    Serves `factory` on an already listening socket, e.g. one passed by
+    systemd's socket activation. systemd keeps the socket open while
+    trompet restarts, so connections wait instead of being refused.
+    """
+
+    def __init__(self, fileno, factory):
+        self.fileno = fileno
+        self.factory = factory
+        self._port = None
+
+    def startService(self):
+        service.Service.startService(self)
+        from twisted.internet import reactor
+        sock = socket.fromfd(self.fileno, socket.AF_INET, socket.SOCK_STREAM)
+        family = sock.getsockopt(socket.SOL_SOCKET, SO_DOMAIN)
+        # systemd passes blocking sockets; the flag is shared with the
+        # adopted file descriptor
+        sock.setblocking(False)
+        sock.close()
+        self._port = reactor.adoptStreamPort(self.fileno, family,
+                                             self.factory)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._port is not None:
+            port, self._port = self._port, None
+            return port.stopListening()
+
+
+def inherited_socket():
+    """Returns the file descriptor of the listening socket that systemd
+    passed to this process (see sd_listen_fds(3)), or `None`. The
+    environment variables are removed, so that child processes don't
+    use the socket, too.
+    """
+    try:
+        pid = int(os.environ.get("LISTEN_PID", ""))
+        fds = int(os.environ.get("LISTEN_FDS", ""))
+    except ValueError:
+        return None
+    if pid != os.getpid() or fds < 1:
+        return None
+    for name in ["LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"]:
+        os.environ.pop(name, None)
+    return LISTEN_FDS_START
+
+
+def protect_resource(resource, config):
+    "Wraps `resource` so that it requires the admin password."
     password = config["web"]["password"]
     portal = Portal(
-        ProjectsListingRealm(trompet),
+        AdminRealm(resource),
         [InMemoryUsernamePasswordDatabaseDontUse(admin=password)])
     credential_factory = DigestCredentialFactory('md5', 'trompet login')
     return HTTPAuthSessionWrapper(portal, [credential_factory])
 
 
+def create_projects_resource(trompet, config):
+    return protect_resource(ProjectsListing(trompet), config)
+
+
 def create_web_service(trompet, config):
     "Creates the web service. Returns a tuple (service, site)."
-    site = Resource()
+    site = ProjectsRoot(trompet)
     trompet.web = site
     site.putChild("", Root())
-    service = internet.TCPServer(config["web"]["port"], server.Site(site))
-    service.setServiceParent(trompet)
+    trompet.site = CapturingSite(trompet, site)
+    fileno = inherited_socket()
+    if fileno is None:
+        web_service = internet.TCPServer(config["web"]["port"], trompet.site)
+    else:
+        web_service = AdoptedPortService(fileno, trompet.site)
+    web_service.setServiceParent(trompet)
 
 
 def reconfigure_web_service(trompet, config):
     trompet.web.putChild("projects", create_projects_resource(trompet, config))
+    trompet.web.putChild(
+        "history", protect_resource(HistoryResource(trompet), config))
+    trompet.web.putChild(
+        "profile", protect_resource(ProfileResource(trompet), config))
+    trompet.web.putChild(
+        "admin", protect_resource(AdminResource(trompet), config))
+    trompet.site.max_request_size = config["web"].get("max request size",
+                                                      MAX_REQUEST_SIZE)
+    if trompet.capture is not None:
+        trompet.capture.close()
+        trompet.capture = None
+    capture_config = config["web"].get("capture")
+    if capture_config:
+        trompet.capture = CaptureWriter(
+            capture_config["directory"],
+            capture_config.get("max file size", 10 * 1024 * 1024),
+            capture_config.get("max files", 10))